@@ -0,0 +1,133 @@
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from cache_db import get_data_version
+from data_utils import read_exchanges
+from facets import SECTORS_AVAILABLE
+from report_builder import NoReportData, load_exchange_year_data, sector_data, build_report
+from report_jobs import _init_worker
+from report_store import DiskReportCache, REPORT_DATA_VERSION, report_key
+
+logger = logging.getLogger("batch_reports")
+
+# Generazione notturna di tutti i report borsa x anno x settore, in parallelo su più processi.
+# Ogni processo carica una sola volta i dati di una borsa/anno e costruisce i report di tutti i settori.
+# uso: python batch_reports.py --out reports_out [--exchanges ...] [--years ...] [--sectors ...] [--workers N]
+
+YEARS = ["2021", "2022", "2023", "2024"]
+SECTORS = ["All"] + SECTORS_AVAILABLE
+
+
+def slug(text):
+    return re.sub(r"[^A-Za-z0-9]+", "_", str(text)).strip("_")
+
+
+def report_path(out_dir, exchange, year, sector):
+    return os.path.join(out_dir, str(year), slug(exchange), f"{slug(sector)}.pdf")
+
+
+def build_exchange_year(exchange, year, sectors, out_dir, data_version, exchanges_file="exchanges.txt", use_cache=True):
+    # Eseguito nel processo worker: restituisce le voci del manifest per i settori richiesti
+    disk = DiskReportCache() if use_cache else None
+    entries = []
+    data = None
+    for sector in sectors:
+        entry = {"exchange": exchange, "year": year, "sector": sector, "file": None, "status": None, "companies": None}
+        key = report_key(exchange, year, sector, data_version)
+        started = time.perf_counter()
+        try:
+            pdf = disk.get(key) if disk else None
+            if pdf is not None:
+                entry["status"] = "cached"
+            else:
+                if data is None:
+                    data = load_exchange_year_data(exchange, year, exchanges_file)
+                rows = sector_data(data, sector)
+                entry["companies"] = len({d.get("symbol") for d in rows})
+                pdf = build_report(exchange, year, sector, rows)
+                entry["status"] = "built"
+                if disk:
+                    disk.put(key, pdf)
+
+            path = report_path(out_dir, exchange, year, sector)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(pdf)
+            entry.update(file=os.path.relpath(path, out_dir), bytes=len(pdf), sha256=hashlib.sha256(pdf).hexdigest())
+        except NoReportData as e:
+            entry.update(status="empty", error=str(e))
+        except Exception as e:
+            logger.warning(f"Report {exchange} {year} {sector} fallito: {e}")
+            entry.update(status="failed", error=str(e) or type(e).__name__)
+        entry["seconds"] = round(time.perf_counter() - started, 3)
+        entries.append(entry)
+    return entries
+
+
+def build_all(out_dir, exchanges=None, years=None, sectors=None, workers=None, exchanges_file="exchanges.txt", use_cache=True):
+    available = read_exchanges(exchanges_file)
+    exchanges = exchanges or list(available)
+    unknown = [e for e in exchanges if e not in available]
+    if unknown:
+        raise ValueError(f"Borse sconosciute: {unknown}")
+    years = [str(y) for y in (years or YEARS)]
+    sectors = sectors or SECTORS
+    workers = workers or os.cpu_count() or 1
+
+    os.makedirs(out_dir, exist_ok=True)
+    data_version = get_data_version(REPORT_DATA_VERSION)
+    started = time.time()
+
+    entries = []
+    context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker) as pool:
+        futures = {
+            pool.submit(build_exchange_year, exchange, year, sectors, out_dir, data_version, exchanges_file, use_cache): (exchange, year)
+            for exchange in exchanges for year in years
+        }
+        for future in as_completed(futures):
+            exchange, year = futures[future]
+            try:
+                done = future.result()
+            except Exception as e:
+                logger.error(f"Borsa {exchange} anno {year} fallita: {e}")
+                done = [{"exchange": exchange, "year": year, "sector": sector, "file": None,
+                         "status": "failed", "error": str(e) or type(e).__name__} for sector in sectors]
+            entries.extend(done)
+            logger.info(f"{exchange} {year}: " + ", ".join(f"{e['sector']}={e['status']}" for e in done))
+
+    entries.sort(key=lambda e: (e["year"], e["exchange"], SECTORS.index(e["sector"]) if e["sector"] in SECTORS else len(SECTORS), e["sector"]))
+    manifest = {
+        "generated_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(started)),
+        "seconds": round(time.time() - started, 1),
+        "data_version": data_version,
+        "workers": workers,
+        "reports": entries,
+    }
+    with open(os.path.join(out_dir, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    return manifest
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generazione batch dei report BalanceShip")
+    parser.add_argument("--out", default="reports_out", help="cartella di destinazione (default: reports_out)")
+    parser.add_argument("--exchanges", nargs="+", help="borse (default: tutte quelle di exchanges.txt)")
+    parser.add_argument("--years", nargs="+", help=f"anni (default: {' '.join(YEARS)})")
+    parser.add_argument("--sectors", nargs="+", help="settori (default: All + tutti i settori)")
+    parser.add_argument("--workers", type=int, default=None, help="processi paralleli (default: numero di CPU)")
+    parser.add_argument("--no-cache", action="store_true", help="non leggere né aggiornare la cache report su disco")
+    args = parser.parse_args()
+
+    manifest = build_all(args.out, args.exchanges, args.years, args.sectors, args.workers, use_cache=not args.no_cache)
+    counts = {}
+    for entry in manifest["reports"]:
+        counts[entry["status"]] = counts.get(entry["status"], 0) + 1
+    print(f"{len(manifest['reports'])} report in {manifest['seconds']} s: {counts} -> {os.path.join(args.out, 'manifest.json')}")
@@ -0,0 +1,298 @@
+import argparse
+import io
+import os
+import logging
+import random
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import pandas as pd
+
+from data_utils import NUMERIC_COLUMNS, remove_duplicates, dedupe_financial_frame
+
+# Benchmark offline (nessun accesso a DB o rete): uso: python benchmarks.py <nome> [--records N]
+
+SECTORS = ['Communication Services', 'Consumer Cyclical', 'Consumer Defensive', 'Energy', 'Financial Services', 'Healthcare', 'Industrials', 'Real Estate', 'Technology', 'Utilities']
+YEARS = [2021, 2022, 2023, 2024]
+
+
+def synthetic_records(n_records, seed=0):
+    # Record finanziari finti con lo stesso schema di get_financial_data_from_source
+    rng = random.Random(seed)
+    n_symbols = max(1, n_records // len(YEARS))
+    records = []
+    for s in range(n_symbols):
+        symbol = f"SYM{s:05d}"
+        sector = rng.choice(SECTORS)
+        for year in YEARS:
+            data = {col: round(rng.uniform(-50, 500), 6) for col in NUMERIC_COLUMNS}
+            data.update({
+                'symbol': symbol,
+                'sector': sector,
+                'industry': f"{sector} {s % 7}",
+                'description': None,
+                'stock_exchange': None,
+                'year': year,
+            })
+            records.append(data)
+    return records[:n_records]
+
+
+def legacy_remove_duplicates(data):
+    # Implementazione storica: tupla di tutti gli item per riga, sensibile all'ordine delle chiavi
+    seen = set()
+    unique_data = []
+    for item in data:
+        if not isinstance(item, dict):
+            continue
+        item_tuple = tuple(item.items())
+        if item_tuple not in seen:
+            seen.add(item_tuple)
+            unique_data.append(item)
+    return unique_data
+
+
+def timed(fn, repeat=3):
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def bench_dedup(n_records=35000):
+    # Un terzo dei record è duplicato (stesso symbol/anno, ordine chiavi diverso, valori aggiornati)
+    records = synthetic_records(n_records)
+    rng = random.Random(1)
+    duplicates = []
+    for r in rng.sample(records, len(records) // 3):
+        dup = dict(reversed(list(r.items())))
+        dup['total_revenue'] = r['total_revenue'] + 1
+        duplicates.append(dup)
+    data = records + duplicates
+    frame = pd.DataFrame.from_records(data)
+
+    t_legacy, legacy = timed(lambda: legacy_remove_duplicates(data))
+    t_list, deduped = timed(lambda: remove_duplicates(data))
+    t_newest, newest = timed(lambda: dedupe_financial_frame(frame, policy='newest'))
+    t_complete, _ = timed(lambda: dedupe_financial_frame(frame, policy='most_complete'))
+    assert len(deduped) == len(newest) == len(records)
+
+    print(f"Dedup, {len(data)} record ({len(duplicates)} duplicati)")
+    print(f"  legacy tuple(item.items()):           {t_legacy * 1000:8.1f} ms  -> {len(legacy)} record")
+    print(f"  remove_duplicates (lista):            {t_list * 1000:8.1f} ms  -> {len(deduped)} record")
+    print(f"  dedupe_financial_frame newest:        {t_newest * 1000:8.1f} ms")
+    print(f"  dedupe_financial_frame most_complete: {t_complete * 1000:8.1f} ms")
+
+
+def bench_charts(n_charts=200, workers=4):
+    # Grafico KPI del report: pyplot (storico, stato globale) contro Figure/Agg, anche da un pool di thread
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    from report_charts import kpi_chart_png
+
+    rng = random.Random(0)
+    series = [pd.Series({k: rng.uniform(-5, 40) for k in ("EBITDA Margin", "Debt/Equity", "FCF Margin", "EPS")})
+              for _ in range(n_charts)]
+
+    def pyplot_chart(median_values):
+        plt.figure(figsize=(6, 4))
+        median_values.plot(kind="bar", color="#0173C4")
+        plt.title("Median KPIs")
+        plt.ylabel("Value")
+        plt.xticks(rotation=45, ha="right")
+        for i, v in enumerate(median_values.values):
+            plt.text(i, v + 0.5, f"{v:.2f}", ha='center')
+        plt.tight_layout()
+        buffer = io.BytesIO()
+        plt.savefig(buffer, format="png")
+        plt.close()
+        return buffer.getvalue()
+
+    def threaded():
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(kpi_chart_png, series))
+
+    t_pyplot, _ = timed(lambda: [pyplot_chart(s) for s in series], repeat=1)
+    t_agg, charts = timed(lambda: [kpi_chart_png(s) for s in series], repeat=1)
+    t_threads, threaded_charts = timed(threaded, repeat=1)
+    assert len(threaded_charts) == n_charts and all(c.startswith(b"\x89PNG") for c in threaded_charts)
+
+    print(f"Grafici KPI report, {n_charts} grafici")
+    print(f"  pyplot:                               {n_charts / t_pyplot:8.1f} grafici/s")
+    print(f"  Figure + Agg:                         {n_charts / t_agg:8.1f} grafici/s")
+    print(f"  Figure + Agg, {workers} thread:                {n_charts / t_threads:8.1f} grafici/s")
+
+
+def bench_ingestion(n_records=2000, latency=0.02, error_rate=0.02):
+    # Ingestione end-to-end senza rete: ReplaySource (latenza ed errori simulati) -> FetchCoordinator
+    # -> save_to_db, su un DB SQLite temporaneo al posto di quello dell'app
+    from sqlalchemy import create_engine
+    from cache_db import Base, Session, engine, read_engine, configure_engines, init_data_versions, FinancialCache
+    from data_sources import ReplaySource, write_synthetic_recordings
+    from fetch_coordinator import FetchCoordinator
+
+    logging.getLogger("cache_db").setLevel(logging.WARNING)
+    logging.getLogger("fetch_coordinator").setLevel(logging.ERROR)
+    years = list(YEARS)
+    with tempfile.TemporaryDirectory() as tmp:
+        symbols = write_synthetic_recordings(os.path.join(tmp, "replay"), max(1, n_records // len(years)), years)
+        print(f"Ingestione replay, {len(symbols)} simboli x {len(years)} anni, latenza {latency * 1000:.0f} ms, errori {error_rate:.0%}")
+        for workers in (1, 4, 16):
+            bench_engine = create_engine(f"sqlite:///{tmp}/ingest_{workers}.db", connect_args={"check_same_thread": False})
+            Base.metadata.create_all(bench_engine)
+            configure_engines(bench_engine)
+            try:
+                init_data_versions()
+                source = ReplaySource(os.path.join(tmp, "replay"), latency=latency, error_rate=error_rate, seed=0)
+                coordinator = FetchCoordinator(max_workers=workers, source=source)
+                start = time.perf_counter()
+                futures = [f for symbol in symbols for f in coordinator.submit(symbol, years)]
+                wait(futures)
+                elapsed = time.perf_counter() - start
+                coordinator.shutdown()
+                failed = sum(1 for f in futures if f.exception() is not None)
+                session = Session()
+                stored = session.query(FinancialCache).count()
+                session.close()
+                print(f"  {workers:2d} worker: {elapsed:6.2f} s  {stored / elapsed:8.1f} record/s  ({stored} salvati, {failed} anni falliti)")
+            finally:
+                configure_engines(engine, read_engine)
+                bench_engine.dispose()
+
+
+def bench_sqlite_concurrency(n_records=4000, readers=4, duration=5.0):
+    # Lettori concorrenti (load_many_from_db) + uno scrittore (save_to_db) sullo stesso file SQLite,
+    # con le impostazioni di default e con il profilo performance di db_engine
+    from cache_db import Base, Session, engine, read_engine, configure_engines, ReadSession, init_data_versions, save_to_db, load_many_from_db
+    from db_engine import make_engine
+
+    logging.getLogger("cache_db").setLevel(logging.WARNING)
+    logging.getLogger("db_engine").setLevel(logging.WARNING)
+    records = synthetic_records(n_records)
+    by_symbol = {}
+    for record in records:
+        by_symbol.setdefault(record['symbol'], []).append(record)
+    symbols = list(by_symbol)
+    print(f"SQLite concorrente, {len(records)} record, {readers} lettori + 1 scrittore per {duration:.0f} s")
+    with tempfile.TemporaryDirectory() as tmp:
+        for profile in ("default", "performance"):
+            bench_engine = make_engine(f"sqlite:///{tmp}/concurrency_{profile}.db", sqlite_profile=profile)
+            Base.metadata.create_all(bench_engine)
+            configure_engines(bench_engine)
+            try:
+                init_data_versions()
+                for symbol, data_list in by_symbol.items():
+                    save_to_db(symbol, YEARS, data_list)
+
+                stop = time.perf_counter() + duration
+                latencies = [[] for _ in range(readers)]
+                writes = []
+
+                def reader(i):
+                    rng = random.Random(i)
+                    while time.perf_counter() < stop:
+                        start = time.perf_counter()
+                        load_many_from_db(rng.sample(symbols, min(50, len(symbols))), YEARS)
+                        latencies[i].append(time.perf_counter() - start)
+                    ReadSession.remove()
+
+                def writer():
+                    rng = random.Random(-1)
+                    while time.perf_counter() < stop:
+                        symbol = rng.choice(symbols)
+                        data_list = [dict(d, net_income=rng.uniform(-50, 500)) for d in by_symbol[symbol]]
+                        save_to_db(symbol, YEARS, data_list)
+                        writes.append(symbol)
+                    Session.remove()
+
+                with ThreadPoolExecutor(max_workers=readers + 1) as pool:
+                    futures = [pool.submit(reader, i) for i in range(readers)] + [pool.submit(writer)]
+                    for future in futures:
+                        future.result()
+                reads = sorted(t for lat in latencies for t in lat)
+                p95 = reads[int(len(reads) * 0.95)] * 1000 if reads else 0
+                print(f"  {profile:12s} letture {len(reads) / duration:8.1f}/s  p95 {p95:7.1f} ms  scritture {len(writes) / duration:7.1f}/s")
+            finally:
+                configure_engines(engine, read_engine)
+                bench_engine.dispose()
+
+
+def bench_payload(n_records=35000):
+    # Serializzazione dei record per data_json: JSON della libreria standard (formato storico) contro
+    # i formati di payload_codec; tempi su tutti i record e dimensione media del payload
+    import json
+    from payload_codec import CODECS, decode_payload, msgpack
+
+    records = synthetic_records(n_records)
+    print(f"Payload cache, {len(records)} record")
+    legacy = [json.dumps(r, ensure_ascii=False, allow_nan=False) for r in records]
+    start = time.perf_counter()
+    [json.dumps(r, ensure_ascii=False, allow_nan=False) for r in records]
+    t_encode = time.perf_counter() - start
+    start = time.perf_counter()
+    [json.loads(p) for p in legacy]
+    t_decode = time.perf_counter() - start
+    size = sum(len(p.encode('utf-8')) for p in legacy) / len(legacy)
+    print(f"  {'json stdlib':12s} scrittura {t_encode:6.2f} s  lettura {t_decode:6.2f} s  {size:6.0f} byte/record")
+
+    for name, codec in CODECS.items():
+        if name == 'msgpack' and msgpack is None:
+            print(f"  {name:12s} non disponibile (pacchetto msgpack non installato)")
+            continue
+        start = time.perf_counter()
+        payloads = [codec.encode(r) for r in records]
+        t_encode = time.perf_counter() - start
+        start = time.perf_counter()
+        decoded = [decode_payload(p) for p in payloads]
+        t_decode = time.perf_counter() - start
+        assert decoded[0] == records[0]
+        size = sum(len(p.encode('utf-8')) for p in payloads) / len(payloads)
+        print(f"  {name:12s} scrittura {t_encode:6.2f} s  lettura {t_decode:6.2f} s  {size:6.0f} byte/record")
+
+
+def bench_records(n_records=35000):
+    # Memoria dei record caricati: dict da JSON contro FinancialRecord (tracemalloc)
+    import json
+    import tracemalloc
+    from financial_record import FinancialRecord
+
+    payloads = [json.dumps(r) for r in synthetic_records(n_records)]
+    print(f"Memoria record, {len(payloads)} record")
+    for name, build in (('dict', json.loads), ('FinancialRecord', lambda p: FinancialRecord(json.loads(p)))):
+        tracemalloc.start()
+        start = time.perf_counter()
+        loaded = [build(p) for p in payloads]
+        elapsed = time.perf_counter() - start
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print(f"  {name:16s} {size / len(loaded):7.0f} byte/record  {size / 1024 ** 2:7.1f} MB  costruzione {elapsed:5.2f} s")
+        del loaded
+
+
+BENCHMARKS = {
+    'dedup': bench_dedup,
+    'charts': bench_charts,
+    'ingestion': bench_ingestion,
+    'sqlite_concurrency': bench_sqlite_concurrency,
+    'payload': bench_payload,
+    'records': bench_records,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark offline BalanceShip")
+    parser.add_argument('name', nargs='?', choices=list(BENCHMARKS), help="benchmark da eseguire (default: tutti)")
+    parser.add_argument('--records', type=int, default=None, help="numero di record sintetici")
+    args = parser.parse_args()
+
+    for name, bench in BENCHMARKS.items():
+        if args.name in (None, name):
+            if args.records:
+                bench(args.records)
+            else:
+                bench()
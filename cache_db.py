@@ -1,11 +1,23 @@
 import os
 import json
+import time
+import hashlib
+import atexit
 import logging
+import threading
+import datetime
+from collections import Counter
+from collections.abc import Mapping
 import pandas as pd
 import numpy as np
-from sqlalchemy import create_engine, Column, String, Text, Integer
+from sqlalchemy import create_engine, Column, String, Text, Integer, DateTime, inspect, text, func, or_, case, cast, null
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.orm import declarative_base, scoped_session, sessionmaker
 from sqlalchemy.orm import Session
+from db_engine import make_engine
+from payload_codec import encode_payload, decode_payload
+from financial_record import FinancialRecord, FINANCIAL_COLUMNS
 import math
 
 # Logging
@@ -15,16 +27,33 @@ logger = logging.getLogger("cache_db")
 # Base ORM
 Base = declarative_base()
 
-# Engine di DB
+# Engine di DB (pool e impostazioni per backend in db_engine)
 if os.environ.get("STREAMLIT_CLOUD") == "1":
     DATABASE_URL = os.environ.get("DATABASE_URL")
-    engine = create_engine(DATABASE_URL, pool_pre_ping=True)
 else:
     os.makedirs("data", exist_ok=True)
     DATABASE_URL = "sqlite:///data/financials_db.db"
-    engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+engine = make_engine(DATABASE_URL)
+# Replica in sola lettura per i load_* delle pagine (DATABASE_READ_URL); senza, si legge dal primario.
+# In locale anche una copia SQLite: DATABASE_READ_URL="sqlite:///file:data/replica.db?mode=ro&uri=true"
+DATABASE_READ_URL = os.environ.get("DATABASE_READ_URL")
+read_engine = make_engine(DATABASE_READ_URL) if DATABASE_READ_URL else engine
 
 Session = scoped_session(sessionmaker(bind=engine))
+ReadSession = scoped_session(sessionmaker(bind=read_engine))
+
+
+def configure_engines(primary, read=None):
+    # Rilega le sessioni (es. a un DB temporaneo nei benchmark); read=None legge dal primario
+    Session.remove()
+    ReadSession.remove()
+    Session.configure(bind=primary)
+    ReadSession.configure(bind=read or primary)
+
+
+def _read_session(primary=False):
+    # primary=True per chi deve vedere subito le proprie scritture (la replica può essere in ritardo)
+    return Session() if primary else ReadSession()
 
 # Modelli tabella
 #class FinancialCache(Base):
@@ -41,6 +70,21 @@ class FinancialCache(Base):
     symbol = Column(String, index=True)
     year = Column(Integer, index=True)
     data_json = Column(String)  # o JSON se usi PostgreSQL con JSONB
+    # Copie di sector/industry dal JSON per filtrare lato SQL
+    sector = Column(String, index=True, nullable=True)
+    industry = Column(String, index=True, nullable=True)
+    # Freschezza: quando è stato scaricato/confermato, hash del contenuto della fonte, esito ('ok' o 'partial')
+    fetched_at = Column(DateTime, index=True, nullable=True)
+    source_hash = Column(String, nullable=True)
+    status = Column(String, index=True, nullable=True)
+
+class Company(Base):
+    # Aziende per borsa, sincronizzate dai file *_companies.txt
+    __tablename__ = 'companies'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    symbol = Column(String, index=True)
+    description = Column(String, nullable=True)
+    stock_exchange = Column(String, index=True)
     
 class KPICache(Base):
     __tablename__ = 'kpi_cache'
@@ -50,12 +94,152 @@ class KPICache(Base):
     year = Column(Integer, index=True)
     kpi_json = Column(Text)
 
+class DataVersion(Base):
+    # Contatore incrementato a ogni salvataggio che modifica i dati: chi costruisce
+    # artefatti derivati (es. report) lo usa per sapere quando rigenerarli
+    __tablename__ = 'data_version'
+    name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+DATA_VERSION_NAMES = ('financials', 'kpis')
+
+class MissingData(Base):
+    # Cache negativa: (symbol, anno) per cui la fonte non ha restituito dati, con l'ora dell'ultimo tentativo
+    __tablename__ = 'missing_data'
+    symbol = Column(String, primary_key=True)
+    year = Column(Integer, primary_key=True)
+    checked_at = Column(DateTime, nullable=False, index=True)
+    attempts = Column(Integer, nullable=False, default=1)
+
+class RefreshState(Base):
+    # Stato dell'aggiornamento periodico per simbolo (refresh_service): visualizzazioni per la priorità,
+    # ultimo aggiornamento riuscito e backoff dopo i fallimenti
+    __tablename__ = 'refresh_state'
+    symbol = Column(String, primary_key=True)
+    views = Column(Integer, nullable=False, default=0)
+    last_viewed = Column(DateTime, nullable=True)
+    last_updated = Column(DateTime, nullable=True, index=True)
+    last_attempt = Column(DateTime, nullable=True)
+    next_attempt = Column(DateTime, nullable=True, index=True)
+    failures = Column(Integer, nullable=False, default=0)
+    last_error = Column(String, nullable=True)
+
+class RefreshRun(Base):
+    # Aggiornamento completo dell'universo, ripristinabile: una riga per esecuzione
+    __tablename__ = 'refresh_runs'
+    run_id = Column(String, primary_key=True)
+    years = Column(String, nullable=False)
+    total = Column(Integer, nullable=False, default=0)
+    started_at = Column(DateTime, nullable=False)
+    finished_at = Column(DateTime, nullable=True)
+
+class RefreshRunItem(Base):
+    # Checkpoint per ticker di un RefreshRun; bucket (hash stabile del simbolo) serve a dividere il lavoro in shard
+    __tablename__ = 'refresh_run_items'
+    run_id = Column(String, primary_key=True)
+    symbol = Column(String, primary_key=True)
+    stock_exchange = Column(String, primary_key=True)
+    description = Column(String, nullable=True)
+    position = Column(Integer, nullable=False)
+    bucket = Column(Integer, nullable=False, index=True)
+    status = Column(String, nullable=False, default='pending', index=True)
+    records = Column(Integer, nullable=True)
+    error = Column(String, nullable=True)
+    updated_at = Column(DateTime, nullable=True)
+
+# Colonne aggiunte dopo la prima versione delle tabelle: (tabella, colonna, tipo SQL)
+ADDED_COLUMNS = [
+    ('cache', 'sector', 'VARCHAR'),
+    ('cache', 'industry', 'VARCHAR'),
+    ('cache', 'fetched_at', 'TIMESTAMP'),
+    ('cache', 'source_hash', 'VARCHAR'),
+    ('cache', 'status', 'VARCHAR'),
+]
+
 def create_tables():
     Base.metadata.bind = engine
     Base.metadata.create_all(engine)
+    migrate_columns()
+    init_data_versions()
     logger.info("✅ Tabelle create o già esistenti.")
 
 
+def migrate_columns():
+    # create_all non aggiunge colonne a tabelle esistenti: le aggiungiamo a mano.
+    # Più processi possono partire insieme (sessioni Streamlit, scheduler, worker): chi perde la corsa
+    # riceve "duplicate column" / "already exists" e trova la colonna già aggiunta dall'altro
+    added = []
+    for table, column, sql_type in ADDED_COLUMNS:
+        if column in {c['name'] for c in inspect(engine).get_columns(table)}:
+            continue
+        try:
+            with engine.begin() as conn:
+                conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {sql_type}"))
+                conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{table}_{column} ON {table} ({column})"))
+        except DBAPIError:
+            if column not in {c['name'] for c in inspect(engine).get_columns(table)}:
+                raise
+            logger.info(f"Colonna {table}.{column} già aggiunta da un altro processo")
+            continue
+        added.append((table, column))
+        logger.info(f"Aggiunta colonna {table}.{column}")
+    if ('cache', 'sector') in added or ('cache', 'industry') in added:
+        backfill_sector_industry()
+
+
+def backfill_sector_industry(batch_size=1000):
+    # Popola sector/industry delle righe salvate prima dell'aggiunta delle colonne
+    session = Session()
+    try:
+        updated = 0
+        while True:
+            rows = session.query(FinancialCache).filter(
+                FinancialCache.sector.is_(None), FinancialCache.id > updated
+            ).order_by(FinancialCache.id).limit(batch_size).all()
+            if not rows:
+                break
+            for row in rows:
+                try:
+                    parsed = decode_payload(row.data_json)
+                except Exception:
+                    parsed = {}
+                row.sector = (parsed or {}).get('sector')
+                row.industry = (parsed or {}).get('industry')
+                updated = row.id
+            session.commit()
+        logger.info("Backfill sector/industry completato")
+    except Exception as e:
+        logger.error(f"Errore backfill sector/industry: {e}")
+        session.rollback()
+    finally:
+        session.close()
+
+
+def init_data_versions():
+    session = Session()
+    try:
+        existing = {name for (name,) in session.query(DataVersion.name)}
+        session.add_all([DataVersion(name=name, version=0) for name in DATA_VERSION_NAMES if name not in existing])
+        session.commit()
+    except Exception as e:
+        logger.error(f"Errore inizializzazione versioni dati: {e}")
+        session.rollback()
+    finally:
+        session.close()
+
+
+def bump_data_version(session, name):
+    # Nella stessa transazione del salvataggio: la versione cambia solo se il commit va a buon fine.
+    # Restituisce il nuovo valore (la riga resta bloccata fino al commit: nessun altro la incrementa nel frattempo)
+    session.query(DataVersion).filter_by(name=name).update(
+        {DataVersion.version: DataVersion.version + 1}, synchronize_session=False
+    )
+    return session.query(DataVersion.version).filter_by(name=name).scalar()
+
+def _version_stamp(name, version):
+    return f"{name}-{version}"
+
+
 #def convert_numpy(obj):
 #    if isinstance(obj, dict):
 #        return {k: convert_numpy(v) for k, v in obj.items()}
@@ -73,7 +257,13 @@ def create_tables():
 #        return obj
 
 def convert_numpy(obj):
-    if isinstance(obj, dict):
+    # Tipi Python nativi per primi: sono quasi tutti i valori dei record
+    kind = type(obj)
+    if kind is float:
+        return obj if math.isfinite(obj) else None
+    elif kind is str or kind is int or obj is None:
+        return obj
+    elif isinstance(obj, dict):
         return {k: convert_numpy(v) for k, v in obj.items()}
     elif isinstance(obj, list):
         return [convert_numpy(v) for v in obj]
@@ -85,19 +275,56 @@ def convert_numpy(obj):
         return int(obj)
     elif isinstance(obj, (np.bool_, bool)):
         return bool(obj)
-    elif obj is None:
-        return None
     else:
         return obj
 
-def save_to_db(symbol, years, data_list):
+# Campi che non vengono dalla fonte (dipendono da chi chiama) e restano fuori dall'hash
+UNHASHED_FIELDS = ('description', 'stock_exchange')
+# Voci di bilancio senza le quali la riga è considerata incompleta
+CORE_FIELDS = ('total_revenue', 'total_assets', 'net_income')
+
+def source_hash(data):
+    content = {k: v for k, v in data.items() if k not in UNHASHED_FIELDS}
+    return hashlib.sha256(json.dumps(content, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def row_status(data):
+    return 'ok' if all(data.get(field) for field in CORE_FIELDS) else 'partial'
+
+# Callback chiamate dopo ogni salvataggio riuscito di FinancialCache (es. indice faccette):
+# ricevono symbol, la lista di (year, sector, industry) salvati e versions, la coppia (prima, dopo) del
+# timbro 'financials' di get_data_version se il salvataggio lo ha cambiato, altrimenti None
+_save_listeners = []
+
+def add_save_listener(callback):
+    if callback not in _save_listeners:
+        _save_listeners.append(callback)
+
+def _notify_save(symbol, saved, versions=None):
+    for callback in list(_save_listeners):
+        try:
+            callback(symbol, saved, versions)
+        except Exception as e:
+            logger.warning(f"Errore listener salvataggio per {symbol}: {e}")
+
+def _same_content(payload, data):
+    # True se il payload salvato decodifica esattamente in data; una riga illeggibile conta come modificata
+    try:
+        return decode_payload(payload) == data
+    except Exception as e:
+        logger.warning(f"Payload salvato non decodificabile, verrà sovrascritto: {e}")
+        return False
+
+def save_to_db(symbol, years, data_list, fetched_at=None):
     session = Session()
+    saved = []
+    changed = False
+    fetched_at = fetched_at or datetime.datetime.utcnow()
     try:
         for i, year in enumerate(years):
             year_int = int(year)
 
             # Salta se il dato manca o è malformato
-            if i >= len(data_list) or not isinstance(data_list[i], dict) or not data_list[i]:
+            if i >= len(data_list) or not isinstance(data_list[i], Mapping) or not data_list[i]:
                 logger.debug(f"Salvataggio SKIPPED per {symbol} anno {year}: no data.")
                 continue
 
@@ -109,22 +336,50 @@ def save_to_db(symbol, years, data_list):
                 logger.warning(f"❌ Mismatch anno nei dati per {symbol}: atteso {year_int}, trovato {data_year}. Salvataggio saltato.")
                 continue
 
-            # Conversione dati e serializzazione JSON
-            data_for_year = convert_numpy(data_for_year)
-            json_data = json.dumps(data_for_year, ensure_ascii=False, allow_nan=False)
+            # Conversione dati e serializzazione (formato in payload_codec)
+            data_for_year = convert_numpy(dict(data_for_year))
+            json_data = encode_payload(data_for_year)
+
+            sector = data_for_year.get("sector")
+            industry = data_for_year.get("industry")
+            fresh = {
+                'fetched_at': fetched_at,
+                'source_hash': source_hash(data_for_year),
+                'status': row_status(data_for_year),
+            }
 
             entry = session.query(FinancialCache).filter_by(symbol=symbol, year=year_int).first()
             if entry:
-                if entry.data_json != json_data:
+                # Anche se il contenuto non cambia, la riga risulta appena verificata
+                for column, value in fresh.items():
+                    setattr(entry, column, value)
+                if entry.data_json != json_data and _same_content(entry.data_json, data_for_year):
+                    # Stesso contenuto in un altro formato (es. JSON storico): si riscrive senza contare come modifica
+                    entry.data_json = json_data
+                elif entry.data_json != json_data:
                     entry.data_json = json_data
+                    entry.sector = sector
+                    entry.industry = industry
+                    changed = True
                     logger.info(f"Aggiornato FinancialCache per {symbol} anno {year_int}")
                 else:
                     logger.debug(f"Nessuna modifica per {symbol} anno {year_int}")
             else:
-                entry = FinancialCache(symbol=symbol, year=year_int, data_json=json_data)
+                entry = FinancialCache(symbol=symbol, year=year_int, data_json=json_data, sector=sector, industry=industry, **fresh)
                 session.add(entry)
+                changed = True
                 logger.info(f"Inserito FinancialCache per {symbol} anno {year_int}")
+            saved.append((year_int, sector, industry))
 
+        if saved:
+            # I dati ora esistono: via le voci della cache negativa
+            session.query(MissingData).filter(
+                MissingData.symbol == symbol, MissingData.year.in_([year for year, _, _ in saved])
+            ).delete(synchronize_session=False)
+        versions = None
+        if changed:
+            version = bump_data_version(session, 'financials')
+            versions = (_version_stamp('financials', version - 1), _version_stamp('financials', version))
         session.commit()
     except Exception as e:
         logger.error(f"Errore salvataggio FinancialCache: {e}")
@@ -133,10 +388,13 @@ def save_to_db(symbol, years, data_list):
     finally:
         session.close()
 
+    if saved:
+        _notify_save(symbol, saved, versions)
 
 
-def load_from_db(symbol, years):
-    session = Session()
+
+def load_from_db(symbol, years, primary=False):
+    session = _read_session(primary)
     try:
         query = session.query(FinancialCache).filter(
             FinancialCache.symbol == symbol,
@@ -147,10 +405,7 @@ def load_from_db(symbol, years):
         data_by_year = {}
         for row in results:
             try:
-                if isinstance(row.data_json, dict):
-                    parsed = row.data_json
-                else:
-                    parsed = json.loads(row.data_json)
+                parsed = FinancialRecord(decode_payload(row.data_json))
                 parsed['year'] = row.year
                 data_by_year[row.year] = parsed
             except Exception as e:
@@ -166,8 +421,8 @@ def load_from_db(symbol, years):
     finally:
         session.close()
 
-def load_many_from_db(symbols, years):
-    session = Session()
+def load_many_from_db(symbols, years, primary=False):
+    session = _read_session(primary)
     try:
         query = session.query(FinancialCache).filter(
             FinancialCache.symbol.in_(symbols),
@@ -178,7 +433,7 @@ def load_many_from_db(symbols, years):
         data_by_symbol_year = {}
         for row in results:
             try:
-                parsed = json.loads(row.data_json) if isinstance(row.data_json, str) else row.data_json
+                parsed = FinancialRecord(decode_payload(row.data_json))
                 parsed['year'] = row.year
                 data_by_symbol_year[(row.symbol, row.year)] = parsed
             except Exception as e:
@@ -193,10 +448,539 @@ def load_many_from_db(symbols, years):
     finally:
         session.close()
 
+def load_freshness(symbols, years, chunk_size=900):
+    # (symbol, year) -> (fetched_at, status) per le righe presenti, senza leggere data_json.
+    # Dal primario, come load_missing: decide cosa riscaricare subito dopo i salvataggi
+    freshness = {}
+    session = Session()
+    try:
+        symbols = list(symbols)
+        years = [int(y) for y in years]
+        for start in range(0, len(symbols), chunk_size):
+            rows = session.query(FinancialCache.symbol, FinancialCache.year, FinancialCache.fetched_at, FinancialCache.status).filter(
+                FinancialCache.symbol.in_(symbols[start:start + chunk_size]),
+                FinancialCache.year.in_(years)
+            )
+            for symbol, year, fetched_at, status in rows:
+                freshness[(symbol, year)] = (fetched_at, status)
+        return freshness
+    except Exception as e:
+        logger.error(f"Errore lettura freschezza dati: {e}")
+        return freshness
+    finally:
+        session.close()
+
+# Campi dello schema che sono anche colonne di FinancialCache: letti senza toccare data_json
+PROJECTED_COLUMNS = {
+    'symbol': FinancialCache.symbol,
+    'year': FinancialCache.year,
+    'sector': FinancialCache.sector,
+    'industry': FinancialCache.industry,
+}
+
+def _json_condition(dialect):
+    # Righe il cui data_json è JSON valido, le sole su cui usare l'estrazione SQL
+    if dialect == 'sqlite':
+        return func.json_valid(FinancialCache.data_json) == 1
+    if dialect == 'postgresql':
+        return FinancialCache.data_json.like('{%')
+    return None
+
+def _json_field(name, dialect):
+    # Estrazione di un campo di data_json lato SQL
+    if dialect == 'sqlite':
+        return func.json_extract(FinancialCache.data_json, f'$."{name}"')
+    return cast(FinancialCache.data_json, JSONB)[name]
+
+def _query_columns(session, records, symbols, years, table_columns, json_columns, condition, chunk_size):
+    dialect = session.get_bind().dialect.name
+    if condition is not None:
+        # data_json serve solo per le righe non JSON (formati binari di payload_codec)
+        extract = [case((condition, _json_field(c, dialect)), else_=null()) for c in json_columns]
+        selected = [PROJECTED_COLUMNS[c] for c in table_columns] + extract + [case((condition, null()), else_=FinancialCache.data_json)]
+    else:
+        selected = [PROJECTED_COLUMNS[c] for c in table_columns] + [FinancialCache.data_json]
+
+    symbols = list(symbols)
+    years = [int(y) for y in years]
+    for start in range(0, len(symbols), chunk_size):
+        rows = session.query(FinancialCache.symbol, FinancialCache.year, *selected).filter(
+            FinancialCache.symbol.in_(symbols[start:start + chunk_size]),
+            FinancialCache.year.in_(years)
+        )
+        for symbol, year, *values in rows:
+            record = FinancialRecord(symbol=symbol, year=year)
+            for column, value in zip(table_columns, values):
+                record[column] = value
+            payload = values[-1]
+            if payload is not None:
+                try:
+                    parsed = decode_payload(payload)
+                except Exception as e:
+                    logger.warning(f"Errore parsing {symbol}-{year}: {e}")
+                    parsed = {}
+                for column in json_columns:
+                    record[column] = parsed.get(column)
+            else:
+                for column, value in zip(json_columns, values[len(table_columns):]):
+                    record[column] = value
+            records[(symbol, year)] = record
+
+def load_many_columns(symbols, years, columns, primary=False, chunk_size=900):
+    # Come load_many_from_db ma con i soli campi indicati (più symbol e year): (symbol, year) -> FinancialRecord.
+    # I campi sono estratti dal JSON lato SQL (json_extract su SQLite, -> su Postgres); le righe in un
+    # formato binario di payload_codec, o un DB senza funzioni JSON, si decodificano in Python
+    columns = list(dict.fromkeys(columns))
+    unknown = [c for c in columns if c not in FINANCIAL_COLUMNS]
+    if unknown:
+        raise ValueError(f"Colonne non valide: {unknown}")
+    table_columns = [c for c in columns if c in PROJECTED_COLUMNS and c not in ('symbol', 'year')]
+    json_columns = [c for c in columns if c not in PROJECTED_COLUMNS]
+
+    records = {}
+    session = _read_session(primary)
+    try:
+        condition = _json_condition(session.get_bind().dialect.name)
+        try:
+            _query_columns(session, records, symbols, years, table_columns, json_columns, condition, chunk_size)
+        except Exception as e:
+            if condition is None:
+                raise
+            # Es. JSON storico con NaN rifiutato dal DB: tutto in Python
+            logger.warning(f"Estrazione JSON lato SQL non riuscita, decodifica in Python: {e}")
+            session.rollback()
+            records.clear()
+            _query_columns(session, records, symbols, years, table_columns, json_columns, None, chunk_size)
+        return records
+    except Exception as e:
+        logger.error(f"Errore caricamento colonne {columns}: {e}")
+        return records
+    finally:
+        session.close()
+
+#-------------------------------------------------------------
+
+def sync_companies(stock_exchange, companies):
+    # Allinea la tabella companies al file della borsa: inserisce i nuovi ticker,
+    # aggiorna le descrizioni cambiate e rimuove quelli non più presenti
+    session = Session()
+    try:
+        wanted = {}
+        for c in companies:
+            ticker = (c.get('ticker') or '').strip()
+            if ticker:
+                wanted[ticker] = c.get('description')
+
+        existing = {row.symbol: row for row in session.query(Company).filter_by(stock_exchange=stock_exchange)}
+        for symbol, row in existing.items():
+            if symbol not in wanted:
+                session.delete(row)
+            elif row.description != wanted[symbol]:
+                row.description = wanted[symbol]
+        session.add_all([
+            Company(symbol=symbol, description=description, stock_exchange=stock_exchange)
+            for symbol, description in wanted.items() if symbol not in existing
+        ])
+        session.commit()
+    except Exception as e:
+        logger.error(f"Errore sincronizzazione aziende {stock_exchange}: {e}")
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+# Colonne ordinabili lato SQL (nome colonna DataFrame -> colonna DB)
+SORTABLE_COLUMNS = {
+    'symbol': FinancialCache.symbol,
+    'year': FinancialCache.year,
+    'sector': FinancialCache.sector,
+    'industry': FinancialCache.industry,
+    'description': Company.description,
+    'stock_exchange': Company.stock_exchange,
+}
+
+def _financials_query(session, columns, exchanges, years, sectors=None, industries=None, search=None):
+    query = session.query(*columns).join(Company, Company.symbol == FinancialCache.symbol).filter(
+        Company.stock_exchange.in_(list(exchanges)),
+        FinancialCache.year.in_([int(y) for y in years])
+    )
+    if sectors:
+        query = query.filter(FinancialCache.sector.in_(list(sectors)))
+    if industries:
+        query = query.filter(FinancialCache.industry.in_(list(industries)))
+    if search:
+        search = search.strip()
+        query = query.filter(or_(
+            Company.symbol.icontains(search, autoescape=True),
+            Company.description.icontains(search, autoescape=True)
+        ))
+    return query
+
+def count_financials(exchanges, years, sectors=None, industries=None, search=None):
+    if not exchanges or not years:
+        return 0
+    session = ReadSession()
+    try:
+        return _financials_query(
+            session, [func.count(FinancialCache.id)], exchanges, years, sectors, industries, search
+        ).scalar() or 0
+    except Exception as e:
+        logger.error(f"Errore conteggio financials: {e}")
+        return 0
+    finally:
+        session.close()
+
+def query_financials(exchanges, years, sectors=None, industries=None, search=None,
+                     sort_by='symbol', ascending=True, page=1, page_size=50, total=None):
+    # Filtri, ordinamento e paginazione eseguiti dal DB: restituisce (DataFrame della pagina, totale righe).
+    # Con page_size=None restituisce tutte le righe filtrate (es. export Excel).
+    # total: risultato di count_financials già calcolato con gli stessi filtri (evita un secondo COUNT)
+    if not exchanges or not years:
+        return pd.DataFrame(), 0
+    if sort_by not in SORTABLE_COLUMNS:
+        raise ValueError(f"Colonna di ordinamento non valida: {sort_by}")
+
+    if total is None:
+        total = count_financials(exchanges, years, sectors, industries, search)
+    session = ReadSession()
+    try:
+        sort_col = SORTABLE_COLUMNS[sort_by]
+        order = [sort_col.asc() if ascending else sort_col.desc()]
+        order += [col.asc() for name, col in SORTABLE_COLUMNS.items() if name in ('symbol', 'year', 'stock_exchange') and name != sort_by]
+
+        query = _financials_query(
+            session,
+            [FinancialCache.symbol, FinancialCache.year, FinancialCache.data_json, Company.description, Company.stock_exchange],
+            exchanges, years, sectors, industries, search
+        ).order_by(*order)
+        if page_size:
+            query = query.offset((max(int(page), 1) - 1) * int(page_size)).limit(int(page_size))
+
+        records = []
+        for symbol, year, data_json, description, stock_exchange in query.all():
+            try:
+                parsed = decode_payload(data_json)
+            except Exception as e:
+                logger.warning(f"Errore parsing {symbol}-{year}: {e}")
+                parsed = {}
+            parsed.update({'symbol': symbol, 'year': year, 'description': description, 'stock_exchange': stock_exchange})
+            records.append(parsed)
+
+        return pd.DataFrame.from_records(records), total
+    except Exception as e:
+        logger.error(f"Errore query financials: {e}")
+        return pd.DataFrame(), 0
+    finally:
+        session.close()
+
+def load_facet_rows():
+    # (stock_exchange, year, sector, industry, symbol) per tutte le righe con almeno una borsa
+    session = ReadSession()
+    try:
+        return session.query(
+            Company.stock_exchange, FinancialCache.year, FinancialCache.sector, FinancialCache.industry, FinancialCache.symbol
+        ).join(Company, Company.symbol == FinancialCache.symbol).all()
+    except Exception as e:
+        logger.error(f"Errore caricamento faccette: {e}")
+        return []
+    finally:
+        session.close()
+
+def load_company_exchanges():
+    # symbol -> insieme delle borse in cui è quotato
+    session = ReadSession()
+    try:
+        exchanges_by_symbol = {}
+        for symbol, stock_exchange in session.query(Company.symbol, Company.stock_exchange):
+            exchanges_by_symbol.setdefault(symbol, set()).add(stock_exchange)
+        return exchanges_by_symbol
+    except Exception as e:
+        logger.error(f"Errore caricamento borse aziende: {e}")
+        return {}
+    finally:
+        session.close()
+
+def get_data_version(names=DATA_VERSION_NAMES):
+    # Timbro dello stato dei dati (es. "financials-12.kpis-3"), cambia a ogni salvataggio con modifiche.
+    # names limita il timbro ai contatori indicati (es. ('financials',))
+    session = Session()
+    try:
+        versions = dict(session.query(DataVersion.name, DataVersion.version))
+        return ".".join(_version_stamp(name, versions.get(name, 0)) for name in names)
+    except Exception as e:
+        logger.error(f"Errore lettura versione dati: {e}")
+        return "unknown"
+    finally:
+        session.close()
+
+#-------------------------------------------------------------
+# Cache negativa
+
+def record_missing(symbol, years):
+    now = datetime.datetime.utcnow()
+    session = Session()
+    try:
+        for year in {int(y) for y in years}:
+            entry = session.get(MissingData, (symbol, year))
+            if entry:
+                entry.checked_at = now
+                entry.attempts = (entry.attempts or 0) + 1
+            else:
+                session.add(MissingData(symbol=symbol, year=year, checked_at=now, attempts=1))
+        session.commit()
+    except Exception as e:
+        logger.warning(f"Errore salvataggio cache negativa per {symbol}: {e}")
+        session.rollback()
+    finally:
+        session.close()
+
+def load_missing(symbols, years, chunk_size=900):
+    # (symbol, year) -> checked_at delle voci della cache negativa
+    missing = {}
+    session = Session()
+    try:
+        symbols = list(symbols)
+        years = [int(y) for y in years]
+        for start in range(0, len(symbols), chunk_size):
+            rows = session.query(MissingData.symbol, MissingData.year, MissingData.checked_at).filter(
+                MissingData.symbol.in_(symbols[start:start + chunk_size]),
+                MissingData.year.in_(years)
+            )
+            for symbol, year, checked_at in rows:
+                missing[(symbol, year)] = checked_at
+        return missing
+    except Exception as e:
+        logger.error(f"Errore lettura cache negativa: {e}")
+        return missing
+    finally:
+        session.close()
+
+#-------------------------------------------------------------
+# Stato degli aggiornamenti periodici
+
+# Le visualizzazioni si accumulano in memoria e si scrivono a blocchi, non a ogni pagina
+VIEW_FLUSH_COUNT = 200
+VIEW_FLUSH_SECONDS = 30
+_view_buffer = Counter()
+_view_lock = threading.Lock()
+_view_flushed_at = time.monotonic()
+
+def record_view(symbol):
+    with _view_lock:
+        _view_buffer[symbol] += 1
+        due = sum(_view_buffer.values()) >= VIEW_FLUSH_COUNT or time.monotonic() - _view_flushed_at > VIEW_FLUSH_SECONDS
+    if due:
+        flush_views()
+
+def flush_views():
+    global _view_flushed_at
+    with _view_lock:
+        pending = dict(_view_buffer)
+        _view_buffer.clear()
+        _view_flushed_at = time.monotonic()
+    if not pending:
+        return
+    now = datetime.datetime.utcnow()
+    session = Session()
+    try:
+        for symbol, count in pending.items():
+            updated = session.query(RefreshState).filter_by(symbol=symbol).update(
+                {RefreshState.views: RefreshState.views + count, RefreshState.last_viewed: now}, synchronize_session=False
+            )
+            if not updated:
+                session.add(RefreshState(symbol=symbol, views=count, last_viewed=now, failures=0))
+        session.commit()
+    except Exception as e:
+        logger.warning(f"Errore salvataggio visualizzazioni: {e}")
+        session.rollback()
+    finally:
+        session.close()
+
+atexit.register(flush_views)
+
+def _reset_views_after_fork():
+    # Le visualizzazioni in attesa appartengono al processo padre, che le scrive: il figlio riparte da zero
+    global _view_buffer, _view_lock, _view_flushed_at
+    _view_buffer = Counter()
+    _view_lock = threading.Lock()
+    _view_flushed_at = time.monotonic()
+
+os.register_at_fork(after_in_child=_reset_views_after_fork)
+
+def ensure_refresh_targets():
+    # Una riga di refresh_state per ogni simbolo della tabella companies
+    session = Session()
+    try:
+        known = {symbol for (symbol,) in session.query(RefreshState.symbol)}
+        symbols = {symbol for (symbol,) in session.query(Company.symbol).distinct()}
+        session.add_all([RefreshState(symbol=symbol, views=0, failures=0) for symbol in sorted(symbols - known)])
+        session.commit()
+        return len(symbols - known)
+    except Exception as e:
+        logger.error(f"Errore inizializzazione refresh_state: {e}")
+        session.rollback()
+        return 0
+    finally:
+        session.close()
+
+def stale_symbols(max_age, limit, now=None):
+    # Simboli da aggiornare in ordine di priorità: più visti prima, poi mai aggiornati / aggiornati da più tempo.
+    # Restituisce (symbol, description, stock_exchange)
+    now = now or datetime.datetime.utcnow()
+    session = Session()
+    try:
+        company = session.query(
+            Company.symbol, func.min(Company.description).label('description'), func.min(Company.stock_exchange).label('stock_exchange')
+        ).group_by(Company.symbol).subquery()
+        rows = session.query(RefreshState.symbol, company.c.description, company.c.stock_exchange).join(
+            company, company.c.symbol == RefreshState.symbol
+        ).filter(
+            or_(RefreshState.last_updated.is_(None), RefreshState.last_updated < now - max_age),
+            or_(RefreshState.next_attempt.is_(None), RefreshState.next_attempt <= now)
+        ).order_by(
+            RefreshState.views.desc(), RefreshState.last_updated.isnot(None), RefreshState.last_updated.asc(), RefreshState.symbol
+        ).limit(limit).all()
+        return [tuple(row) for row in rows]
+    except Exception as e:
+        logger.error(f"Errore selezione simboli da aggiornare: {e}")
+        return []
+    finally:
+        session.close()
+
+def mark_refresh(symbol, ok, error=None, backoff=None):
+    # Esito di un aggiornamento: se riuscito azzera i fallimenti, altrimenti rimanda il prossimo tentativo
+    # di backoff(fallimenti consecutivi) (timedelta)
+    now = datetime.datetime.utcnow()
+    session = Session()
+    try:
+        state = session.get(RefreshState, symbol)
+        if state is None:
+            state = RefreshState(symbol=symbol, views=0, failures=0)
+            session.add(state)
+        state.last_attempt = now
+        if ok:
+            state.last_updated = now
+            state.failures = 0
+            state.next_attempt = None
+            state.last_error = None
+        else:
+            state.failures = (state.failures or 0) + 1
+            state.last_error = (error or '')[:500] or None
+            state.next_attempt = now + backoff(state.failures) if backoff else None
+        session.commit()
+        return state.failures
+    except Exception as e:
+        logger.warning(f"Errore aggiornamento refresh_state per {symbol}: {e}")
+        session.rollback()
+        return None
+    finally:
+        session.close()
+
+#-------------------------------------------------------------
+# Aggiornamento completo con checkpoint
+
+def symbol_bucket(symbol):
+    # Hash stabile tra processi e macchine (hash() di Python cambia a ogni avvio); 28 bit per stare in un INTEGER
+    return int(hashlib.sha1(symbol.encode('utf-8')).hexdigest()[:7], 16)
+
+def create_refresh_run(run_id, years, items, chunk_size=1000):
+    # items: (symbol, stock_exchange, description) nell'ordine di elaborazione
+    session = Session()
+    try:
+        session.add(RefreshRun(run_id=run_id, years=','.join(str(y) for y in years), total=len(items),
+                               started_at=datetime.datetime.utcnow()))
+        for start in range(0, len(items), chunk_size):
+            session.add_all([
+                RefreshRunItem(run_id=run_id, symbol=symbol, stock_exchange=stock_exchange, description=description,
+                               position=start + i, bucket=symbol_bucket(symbol), status='pending')
+                for i, (symbol, stock_exchange, description) in enumerate(items[start:start + chunk_size])
+            ])
+            session.flush()
+        session.commit()
+    except Exception as e:
+        logger.error(f"Errore creazione refresh run {run_id}: {e}")
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+def load_refresh_run(run_id=None):
+    # (run_id, anni) dell'esecuzione indicata o dell'ultima non conclusa; None se non esiste
+    session = Session()
+    try:
+        query = session.query(RefreshRun)
+        if run_id:
+            run = query.filter_by(run_id=run_id).first()
+        else:
+            run = query.filter(RefreshRun.finished_at.is_(None)).order_by(RefreshRun.started_at.desc()).first()
+        return (run.run_id, run.years.split(',')) if run else None
+    finally:
+        session.close()
+
+def pending_run_items(run_id, shard=0, shards=1, limit=100, statuses=('pending',)):
+    # Prossimi ticker da elaborare di questo shard, nell'ordine originale
+    session = Session()
+    try:
+        rows = session.query(RefreshRunItem.symbol, RefreshRunItem.stock_exchange, RefreshRunItem.description).filter(
+            RefreshRunItem.run_id == run_id,
+            RefreshRunItem.status.in_(list(statuses)),
+            RefreshRunItem.bucket % shards == shard
+        ).order_by(RefreshRunItem.position).limit(limit).all()
+        return [tuple(row) for row in rows]
+    finally:
+        session.close()
+
+def mark_run_items(run_id, results):
+    # results: (symbol, stock_exchange, status, records, error); un commit = un checkpoint
+    now = datetime.datetime.utcnow()
+    session = Session()
+    try:
+        for symbol, stock_exchange, status, records, error in results:
+            session.query(RefreshRunItem).filter_by(run_id=run_id, symbol=symbol, stock_exchange=stock_exchange).update(
+                {'status': status, 'records': records, 'error': (error or '')[:500] or None, 'updated_at': now},
+                synchronize_session=False
+            )
+        session.commit()
+    except Exception as e:
+        logger.error(f"Errore checkpoint refresh run {run_id}: {e}")
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+def refresh_run_progress(run_id):
+    # stato -> numero di ticker; chiude l'esecuzione quando non resta nulla in 'pending'
+    session = Session()
+    try:
+        counts = dict(session.query(RefreshRunItem.status, func.count()).filter_by(run_id=run_id).group_by(RefreshRunItem.status))
+        if counts and not counts.get('pending'):
+            session.query(RefreshRun).filter(RefreshRun.run_id == run_id, RefreshRun.finished_at.is_(None)).update(
+                {'finished_at': datetime.datetime.utcnow()}, synchronize_session=False
+            )
+            session.commit()
+        return counts
+    finally:
+        session.close()
+
+def reset_failed_run_items(run_id):
+    session = Session()
+    try:
+        updated = session.query(RefreshRunItem).filter_by(run_id=run_id, status='failed').update(
+            {'status': 'pending'}, synchronize_session=False
+        )
+        if updated:
+            session.query(RefreshRun).filter_by(run_id=run_id).update({'finished_at': None}, synchronize_session=False)
+        session.commit()
+        return updated
+    finally:
+        session.close()
+
 #-------------------------------------------------------------
 
 def save_kpis_to_db(kpi_df):
     session = Session()
+    inserted = False
     try:
         for _, row in kpi_df.iterrows():
             symbol = row['symbol']
@@ -218,8 +1002,11 @@ def save_kpis_to_db(kpi_df):
 
             entry = KPICache(symbol=symbol, year=year, description=desc, kpi_json=json_data)
             session.add(entry)
+            inserted = True
             logger.info(f"Inserito KPICache per {symbol} anno {year}")
 
+        if inserted:
+            bump_data_version(session, 'kpis')
         session.commit()
     except Exception as e:
         logger.error(f"Errore salvataggio KPICache: {e}")
@@ -231,7 +1018,7 @@ def save_kpis_to_db(kpi_df):
 
 
 def load_kpis_for_symbol_year(symbol, year, description=None):
-    session = Session()
+    session = ReadSession()
     try:
         query = session.query(KPICache).filter_by(symbol=symbol, year=year)
         if description is not None:
@@ -255,7 +1042,7 @@ def load_kpis_for_symbol_year(symbol, year, description=None):
         session.close()
 
 def load_all_kpis():
-    session = Session()
+    session = ReadSession()
     try:
         entries = session.query(KPICache).all()
         if not entries:
@@ -287,3 +1074,7 @@ def load_all_kpis():
     finally:
         session.close()
 
+
+
+# Crea tabelle e colonne mancanti all'avvio (idempotente)
+create_tables()
@@ -0,0 +1,304 @@
+import os
+import re
+import json
+import time
+import random
+import logging
+import argparse
+import threading
+from abc import ABC, abstractmethod
+
+import pandas as pd
+
+from rate_limiter import get_rate_limiter, THROTTLED, ERROR
+from financial_record import FinancialRecord
+
+logger = logging.getLogger("data_sources")
+
+# Fonti dei bilanci. Ogni fonte espone fetch(symbol, years, description, stock_exchange) -> lista di record
+# (uno per anno trovato, stesso schema di FINANCIAL_COLUMNS): lista vuota = nessun dato per il simbolo,
+# SourceError = errore temporaneo (rete, throttling), da non scambiare per "dati assenti".
+#   DATA_SOURCE=yahoo   (default) Yahoo Finance tramite yfinance
+#   DATA_SOURCE=replay  bilanci registrati su disco (REPLAY_DIR), con latenza e tasso di errore simulati
+
+DATA_SOURCE = os.environ.get("DATA_SOURCE", "yahoo")
+REPLAY_DIR = os.environ.get("REPLAY_DIR", os.path.join("data", "replay"))
+REPLAY_LATENCY = float(os.environ.get("REPLAY_LATENCY", 0.05))
+REPLAY_ERROR_RATE = float(os.environ.get("REPLAY_ERROR_RATE", 0.0))
+
+STATEMENTS = ("financials", "balance_sheet", "cashflow")
+
+# campo del record -> (prospetto, voce di bilancio); i valori monetari sono convertiti in miliardi
+FIELDS = {
+    'total_revenue': ('financials', 'Total Revenue'),
+    'operating_revenue': ('financials', 'Operating Revenue'),
+    'cost_of_revenue': ('financials', 'Cost Of Revenue'),
+    'gross_profit': ('financials', 'Gross Profit'),
+    'operating_expense': ('financials', 'Operating Expense'),
+    'sg_and_a': ('financials', 'Selling General And Administration'),
+    'r_and_d': ('financials', 'Research And Development'),
+    'operating_income': ('financials', 'Operating Income'),
+    'net_non_operating_interest_income_expense': ('financials', 'Net Non Operating Interest Income Expense'),
+    'interest_expense_non_operating': ('financials', 'Interest Expense Non Operating'),
+    'pretax_income': ('financials', 'Pretax Income'),
+    'tax_provision': ('financials', 'Tax Provision'),
+    'net_income_common_stockholders': ('financials', 'Net Income Common Stockholders'),
+    'net_income': ('financials', 'Net Income'),
+    'net_income_continuous_operations': ('financials', 'Net Income Continuous Operations'),
+    'basic_eps': ('financials', 'Basic EPS'),
+    'diluted_eps': ('financials', 'Diluted EPS'),
+    'basic_average_shares': ('financials', 'Basic Average Shares'),
+    'diluted_average_shares': ('financials', 'Diluted Average Shares'),
+    'total_expenses': ('financials', 'Total Expenses'),
+    'normalized_income': ('financials', 'Normalized Income'),
+    'interest_expense': ('financials', 'Interest Expense'),
+    'net_interest_income': ('financials', 'Net Interest Income'),
+    'ebit': ('financials', 'EBIT'),
+    'ebitda': ('financials', 'EBITDA'),
+    'reconciled_depreciation': ('financials', 'Reconciled Depreciation'),
+    'normalized_ebitda': ('financials', 'Normalized EBITDA'),
+    'total_assets': ('balance_sheet', 'Total Assets'),
+    'stockholders_equity': ('balance_sheet', 'Stockholders Equity'),
+    'free_cash_flow': ('cashflow', 'Free Cash Flow'),
+    'changes_in_cash': ('cashflow', 'Changes In Cash'),
+    'working_capital': ('balance_sheet', 'Working Capital'),
+    'invested_capital': ('balance_sheet', 'Invested Capital'),
+    'total_debt': ('balance_sheet', 'Total Debt'),
+}
+# Valori per azione: non convertiti in miliardi
+UNSCALED_FIELDS = {'basic_eps', 'diluted_eps'}
+
+
+class SourceError(Exception):
+    pass
+
+
+class RateLimited(SourceError):
+    # La fonte ha rifiutato la richiesta per troppe chiamate (HTTP 429)
+    pass
+
+
+def format_to_billions(x):
+    try:
+        return float(x) / 1e9
+    except (TypeError, ValueError):
+        return 0
+
+
+def statements_to_records(symbol, years, statements, info, description=None, stock_exchange=None):
+    # Dai prospetti (DataFrame voci x date di chiusura) ai record per anno; gli anni assenti sono saltati
+    financials = statements["financials"]
+    if all(statements[name].empty for name in STATEMENTS):
+        return []
+
+    columns_by_year = {}
+    for col in financials.columns:
+        try:
+            columns_by_year.setdefault(pd.to_datetime(col).year, col)
+        except (TypeError, ValueError):
+            continue
+
+    records = []
+    for year in years:
+        year_column = columns_by_year.get(int(year))
+        if year_column is None:
+            logger.debug(f"Year {year} not found for symbol {symbol}")
+            continue
+
+        data = FinancialRecord(
+            symbol=symbol,
+            sector=info.get('sector', 'N/A'),
+            industry=info.get('industry', 'N/A'),
+            description=description,
+            stock_exchange=stock_exchange,
+            year=int(year),
+        )
+        for field, (statement, item) in FIELDS.items():
+            frame = statements[statement]
+            value = frame.loc[item, year_column] if item in frame.index and year_column in frame.columns else 0
+            data[field] = value if field in UNSCALED_FIELDS else format_to_billions(value)
+        records.append(data)
+    return records
+
+
+class DataSource(ABC):
+    name = "base"
+
+    @abstractmethod
+    def fetch(self, symbol, years, description=None, stock_exchange=None):
+        ...
+
+
+class YahooSource(DataSource):
+    name = "yahoo"
+
+    def __init__(self, record_dir=None, limiter=None):
+        # Con record_dir salva anche i prospetti grezzi scaricati, riutilizzabili da ReplaySource
+        self.record_dir = record_dir
+        # Ritmo delle richieste adattato alle risposte di Yahoo (al posto di pause casuali fisse)
+        self.limiter = limiter or get_rate_limiter("yahoo")
+
+    def download(self, symbol):
+        import yfinance as yf
+        from yfinance.exceptions import YFRateLimitError
+        with self.limiter.slot() as report:
+            try:
+                stock = yf.Ticker(symbol)
+                statements = {"financials": stock.financials, "balance_sheet": stock.balance_sheet, "cashflow": stock.cashflow}
+                info = stock.info
+            except YFRateLimitError as e:
+                report(THROTTLED)
+                raise RateLimited(f"Rate limit Yahoo per {symbol}: {e}") from e
+            except Exception as e:
+                report(ERROR)
+                raise SourceError(f"Error retrieving financial data for {symbol}: {e}") from e
+            # Un payload del tutto vuoto è spesso throttling silenzioso: rallenta come per un 429 e non va
+            # scambiato per "nessun dato" (finirebbe nella cache negativa)
+            if all(statements[name].empty for name in STATEMENTS) and not info:
+                report(THROTTLED)
+                raise RateLimited(f"Payload vuoto da Yahoo per {symbol} (probabile throttling)")
+        if self.record_dir:
+            save_recording(self.record_dir, symbol, statements, info)
+        return statements, info
+
+    def fetch(self, symbol, years, description=None, stock_exchange=None):
+        statements, info = self.download(symbol)
+        return statements_to_records(symbol, years, statements, info, description, stock_exchange)
+
+
+def _recording_path(directory, symbol):
+    return os.path.join(directory, re.sub(r"[^A-Za-z0-9._-]", "_", symbol) + ".json")
+
+
+def save_recording(directory, symbol, statements, info):
+    os.makedirs(directory, exist_ok=True)
+    payload = {
+        "symbol": symbol,
+        "info": {k: info.get(k) for k in ("sector", "industry", "longName") if info.get(k) is not None},
+    }
+    for name in STATEMENTS:
+        frame = statements[name]
+        payload[name] = {
+            "index": [str(i) for i in frame.index],
+            "columns": [str(c) for c in frame.columns],
+            "data": frame.astype(object).where(frame.notna(), None).values.tolist(),
+        }
+    with open(_recording_path(directory, symbol), "w", encoding="utf-8") as f:
+        json.dump(payload, f, default=float)
+
+
+def load_recording(directory, symbol):
+    # (prospetti, info) oppure None se il simbolo non è stato registrato
+    try:
+        with open(_recording_path(directory, symbol), encoding="utf-8") as f:
+            payload = json.load(f)
+    except FileNotFoundError:
+        return None
+    statements = {
+        name: pd.DataFrame(payload[name]["data"], index=payload[name]["index"], columns=payload[name]["columns"], dtype="float64")
+        for name in STATEMENTS
+    }
+    return statements, payload.get("info", {})
+
+
+class ReplaySource(DataSource):
+    # Serve bilanci registrati su disco come se arrivassero dalla rete: latenza (media, +/- jitter)
+    # e una quota di errori temporanei, riproducibili con seed
+    name = "replay"
+
+    def __init__(self, directory=REPLAY_DIR, latency=REPLAY_LATENCY, jitter=0.5, error_rate=REPLAY_ERROR_RATE, seed=None):
+        self.directory = directory
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def fetch(self, symbol, years, description=None, stock_exchange=None):
+        with self._lock:
+            delay = self.latency * (1 + self._rng.uniform(-self.jitter, self.jitter))
+            fail = self._rng.random() < self.error_rate
+        if delay > 0:
+            time.sleep(delay)
+        if fail:
+            raise SourceError(f"Errore simulato per {symbol}")
+        recording = load_recording(self.directory, symbol)
+        if recording is None:
+            return []
+        statements, info = recording
+        return statements_to_records(symbol, years, statements, info, description, stock_exchange)
+
+
+SOURCES = {
+    "yahoo": YahooSource,
+    "replay": ReplaySource,
+}
+
+_source = None
+_source_lock = threading.Lock()
+
+
+def get_data_source():
+    global _source
+    with _source_lock:
+        if _source is None:
+            if DATA_SOURCE not in SOURCES:
+                raise ValueError(f"DATA_SOURCE non valida: {DATA_SOURCE} (ammesse: {list(SOURCES)})")
+            _source = SOURCES[DATA_SOURCE]()
+            logger.info(f"Fonte dati: {_source.name}")
+        return _source
+
+
+def set_data_source(source):
+    # Sostituisce la fonte del processo (es. benchmark); restituisce la precedente
+    global _source
+    with _source_lock:
+        previous, _source = _source, source
+        return previous
+
+
+def _reset_after_fork():
+    # La fonte del padre tiene limitatore e lock del processo padre: il figlio ne crea una propria da DATA_SOURCE
+    global _source, _source_lock
+    _source = None
+    _source_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def write_synthetic_recordings(directory, n_symbols, years=(2021, 2022, 2023, 2024), seed=0):
+    # Registrazioni finte con la struttura dei prospetti Yahoo, per prove senza rete; restituisce i simboli
+    rng = random.Random(seed)
+    sectors = ['Energy', 'Technology', 'Utilities', 'Industrials', 'Healthcare', 'Financial Services']
+    dates = [f"{year}-12-31" for year in sorted(years, reverse=True)]
+    symbols = []
+    for s in range(n_symbols):
+        symbol = f"RPL{s:05d}"
+        statements = {}
+        for name in STATEMENTS:
+            items = sorted({item for statement, item in FIELDS.values() if statement == name})
+            statements[name] = pd.DataFrame(
+                [[rng.uniform(-2, 15) if "EPS" in item else rng.uniform(-5e9, 5e10) for _ in dates] for item in items],
+                index=items, columns=dates
+            )
+        sector = rng.choice(sectors)
+        save_recording(directory, symbol, statements, {"sector": sector, "industry": f"{sector} {s % 5}"})
+        symbols.append(symbol)
+    return symbols
+
+
+if __name__ == "__main__":
+    # Registra da Yahoo i prospetti dei simboli indicati, per usarli poi con DATA_SOURCE=replay
+    parser = argparse.ArgumentParser(description="Registrazione dei bilanci per la fonte replay")
+    parser.add_argument("symbols", nargs="+", help="simboli da registrare")
+    parser.add_argument("--dir", default=REPLAY_DIR, help=f"cartella delle registrazioni (default: {REPLAY_DIR})")
+    args = parser.parse_args()
+
+    source = YahooSource(record_dir=args.dir)
+    for symbol in args.symbols:
+        try:
+            source.download(symbol)
+            print(f"{symbol}: registrato")
+        except SourceError as e:
+            print(f"{symbol}: {e}")
@@ -1,14 +1,23 @@
 import os
 from flask import Flask, render_template, request, jsonify
-import yfinance as yf
 import csv
 import pickle
 import pandas as pd
 import time
 import atexit
 import datetime
+from collections.abc import Mapping
+from concurrent.futures import wait
 from cache_db import load_from_db
+from cache_db import load_many_from_db
+from cache_db import load_many_columns
 from cache_db import save_to_db
+from cache_db import sync_companies
+from cache_db import record_view
+from fetch_coordinator import get_fetch_coordinator
+from refresh_planner import plan_refresh, known_missing
+from data_sources import get_data_source, SourceError
+from financial_record import FINANCIAL_COLUMNS, TEXT_COLUMNS, NUMERIC_COLUMNS, FinancialRecord
 import random
 import streamlit as st
 
@@ -37,104 +46,11 @@ def read_companies(filename):
 ##        return "N/A"
     
 def get_financial_data_from_source(symbol, years, description=None, stock_exchange=None):
-    #Scarica i dati finanziari da Yahoo Finance per ogni anno richiesto
-
-    def format_to_billions(x):
-        try:
-            return float(x) / 1e9
-        except:
-            return 0
-
-    results = []
-
+    # Scarica i dati finanziari dalla fonte configurata (data_sources) per ogni anno richiesto
     try:
-        stock = yf.Ticker(symbol)
-        financials = stock.financials
-        balance_sheet = stock.balance_sheet
-        cashflow = stock.cashflow
-        info = stock.info
-
-        if financials.empty and balance_sheet.empty and cashflow.empty:
-            print(f"No financial data found for symbol: {symbol}")
-            return []
-
-        # Ottieni anni disponibili nei dati
-        #columns_years = [col.year for col in financials.columns if isinstance(col, pd.Timestamp)]
-        columns_years = []
-        for col in financials.columns:
-            try:
-                parsed = pd.to_datetime(col)
-                columns_years.append(parsed.year)
-            except:
-                continue
-        print(f"[{symbol}] Anni trovati in financials: {columns_years}")
-
-
-
-        for year in years:
-            sleep_time = random.uniform(4, 8)
-            time.sleep(sleep_time)
-            if year not in columns_years:
-                print(f"Year {year} not found for symbol {symbol}")
-                continue
-
-            year_index = columns_years.index(year)
-            year_column = financials.columns[year_index]
-
-            # Funzioni di utilità per prendere i dati in modo sicuro
-            def f(idx): return financials.loc[idx, year_column] if idx in financials.index else 0
-            def fb(idx): return balance_sheet.loc[idx, year_column] if idx in balance_sheet.index else 0
-            def fc(idx): return cashflow.loc[idx, year_column] if idx in cashflow.index else 0
-
-            data = {
-                'symbol': symbol,
-                'sector': info.get('sector', 'N/A'),
-                'industry': info.get('industry', 'N/A'),
-                'description': description,
-                'stock_exchange': stock_exchange,
-                'year': year,
-                'total_revenue': format_to_billions(f('Total Revenue')),
-                'operating_revenue': format_to_billions(f('Operating Revenue')),
-                'cost_of_revenue': format_to_billions(f('Cost Of Revenue')),
-                'gross_profit': format_to_billions(f('Gross Profit')),
-                'operating_expense': format_to_billions(f('Operating Expense')),
-                'sg_and_a': format_to_billions(f('Selling General And Administration')),
-                'r_and_d': format_to_billions(f('Research And Development')),
-                'operating_income': format_to_billions(f('Operating Income')),
-                'net_non_operating_interest_income_expense': format_to_billions(f('Net Non Operating Interest Income Expense')),
-                'interest_expense_non_operating': format_to_billions(f('Interest Expense Non Operating')),
-                'pretax_income': format_to_billions(f('Pretax Income')),
-                'tax_provision': format_to_billions(f('Tax Provision')),
-                'net_income_common_stockholders': format_to_billions(f('Net Income Common Stockholders')),
-                'net_income': format_to_billions(f('Net Income')),
-                'net_income_continuous_operations': format_to_billions(f('Net Income Continuous Operations')),
-                'basic_eps': f('Basic EPS'),
-                'diluted_eps': f('Diluted EPS'),
-                'basic_average_shares': format_to_billions(f('Basic Average Shares')),
-                'diluted_average_shares': format_to_billions(f('Diluted Average Shares')),
-                'total_expenses': format_to_billions(f('Total Expenses')),
-                'normalized_income': format_to_billions(f('Normalized Income')),
-                'interest_expense': format_to_billions(f('Interest Expense')),
-                'net_interest_income': format_to_billions(f('Net Interest Income')),
-                'ebit': format_to_billions(f('EBIT')),
-                'ebitda': format_to_billions(f('EBITDA')),
-                'reconciled_depreciation': format_to_billions(f('Reconciled Depreciation')),
-                'normalized_ebitda': format_to_billions(f('Normalized EBITDA')),
-                'total_assets': format_to_billions(fb('Total Assets')),
-                'stockholders_equity': format_to_billions(fb("Stockholders Equity")),
-                'free_cash_flow': format_to_billions(fc("Free Cash Flow")),
-                'changes_in_cash': format_to_billions(fc('Changes In Cash')),
-                'working_capital': format_to_billions(fb("Working Capital")),
-                'invested_capital': format_to_billions(fb("Invested Capital")),
-                'total_debt': format_to_billions(fb("Total Debt")),
-            }
-
-            results.append(data)
-            time.sleep(random.uniform(4, 8))
-        return results
-
-    except Exception as e:
-        print(f"Error retrieving financial data for {symbol}: {e}")
+        return get_data_source().fetch(symbol, years, description=description, stock_exchange=stock_exchange)
+    except SourceError as e:
+        print(e)
         return []
 
 
@@ -145,87 +61,137 @@ def get_financial_data(symbol, years, force_refresh=False, description=None, sto
     # Carica dati cached (None se non disponibili)
     cached_data = load_from_db(symbol, years)
 
-    # Trova anni mancanti (dove cached_data[i] è None)
-    missing_years = [year for i, year in enumerate(years) if cached_data[i] is None]
+    # Anni da scaricare: solo i mancanti, oppure con force_refresh anche quelli oltre il TTL del loro anno
+    if force_refresh:
+        years_to_fetch = plan_refresh([symbol], years).get(symbol, [])
+    else:
+        years_to_fetch = [year for i, year in enumerate(years) if cached_data[i] is None]
+        if years_to_fetch:
+            missing = known_missing([symbol], years_to_fetch)
+            years_to_fetch = [year for year in years_to_fetch if (symbol, int(year)) not in missing]
 
     # BLOCCO PER STREAMLIT CLOUD
     #if os.environ.get("STREAMLIT_CLOUD") == "1":
     #    return cached_data
-    if missing_years or force_refresh:
-        # Scarica dati mancanti
-        new_data = get_financial_data_from_source(symbol, missing_years, description=description, stock_exchange=stock_exchange)
-        if new_data:
-            # Salva nuovi dati nel DB/cache
-            save_to_db(symbol, missing_years, new_data)
-
-            # Integra i dati scaricati nei dati cached
-            for i, year in enumerate(years):
-                if cached_data[i] is None and year in missing_years:
-                    idx = missing_years.index(year)
-                    #cached_data[i] = new_data[idx]
-                    if idx < len(new_data):
-                        cached_data[i] = new_data[idx]
-                    else:
-                        cached_data[i] = None                 
- 
-    return cached_data
+    if years_to_fetch:
+        # Scarica e salva (nel coordinatore) e integra i dati scaricati nei dati cached
+        new_data = get_fetch_coordinator().fetch(symbol, years_to_fetch, description=description, stock_exchange=stock_exchange, refresh=force_refresh)
+        fetched = dict(zip([str(y) for y in years_to_fetch], new_data))
+        for i, year in enumerate(years):
+            if fetched.get(str(year)) is not None:
+                cached_data[i] = fetched[str(year)]
 
+    return cached_data
 
 
-def remove_duplicates(data):
-    seen = set()
-    unique_data = []
-    for item in data:
-        if not isinstance(item, dict):  # Salta None o altri tipi non validi
-            continue
-        item_tuple = tuple(item.items())
-        if item_tuple not in seen:
-            seen.add(item_tuple)
-            unique_data.append(item)
-    return unique_data
+DEDUP_POLICIES = ('newest', 'most_complete')
+
+
+def dedupe_financial_frame(df, policy='newest'):
+    # Una sola riga per (symbol, year), calcolata per colonne:
+    # - 'newest': vince la riga scaricata più di recente (fetched_at se presente, altrimenti l'ultima arrivata)
+    # - 'most_complete': vince la riga con più valori numerici valorizzati (a parità, la più recente)
+    if policy not in DEDUP_POLICIES:
+        raise ValueError(f"Policy di deduplica non valida: {policy} (ammesse: {DEDUP_POLICIES})")
+    if df.empty:
+        return df
+
+    order = pd.DataFrame({'_pos': range(len(df))})
+    sort_cols = []
+    if policy == 'most_complete':
+        numeric = df.reindex(columns=NUMERIC_COLUMNS).apply(pd.to_numeric, errors='coerce')
+        order['_filled'] = (numeric.notna() & numeric.ne(0)).sum(axis=1).to_numpy()
+        sort_cols.append('_filled')
+    if 'fetched_at' in df.columns:
+        order['_fetched_at'] = pd.to_datetime(df['fetched_at'].to_numpy(), errors='coerce')
+        sort_cols.append('_fetched_at')
+    sort_cols.append('_pos')
+
+    order['_symbol'] = df['symbol'].astype(str).to_numpy()
+    order['_year'] = pd.to_numeric(df['year'], errors='coerce').to_numpy()
+    order = order.sort_values(sort_cols, kind='stable', na_position='first')
+    keep = order.drop_duplicates(subset=['_symbol', '_year'], keep='last')
+    return df.iloc[keep['_pos'].sort_values().to_numpy()]
+
+
+def remove_duplicates(data, policy='newest'):
+    # Salta None o altri tipi non validi e i record senza chiave symbol/year
+    valid = [item for item in data if isinstance(item, Mapping) and 'symbol' in item and 'year' in item]
+    if not valid:
+        return []
+    frame = pd.DataFrame.from_records(valid, columns=['symbol', 'year', 'fetched_at'] + NUMERIC_COLUMNS)
+    if frame['fetched_at'].isna().all():
+        frame = frame.drop(columns=['fetched_at'])
+    kept = dedupe_financial_frame(frame, policy=policy)
+    return [valid[i] for i in kept.index]
+
+
+
+def sync_company_table(exchanges):
+    # Copia nel DB le aziende di ogni borsa, per i filtri lato SQL (query_financials)
+    for name, filename in exchanges.items():
+        sync_companies(name, read_companies(filename))
+
+
+def typed_financial_frame(df):
+    # Ordine colonne e tipi comuni a tutte le tabelle dei dati finanziari
+    df = df.reindex(columns=FINANCIAL_COLUMNS)
+    df[NUMERIC_COLUMNS] = df[NUMERIC_COLUMNS].apply(pd.to_numeric, errors='coerce').astype('float64')
+    df['year'] = df['year'].astype('int64')
+    for col in ('sector', 'industry', 'stock_exchange'):
+        df[col] = df[col].astype('category')
+    return df
+
+
+ALL_YEARS = ['2021', '2022', '2023', '2024']
+
+
+def iter_all_financial_data(force_refresh=True, years=None, exchanges_file='exchanges.txt', chunk_size=20):
+    # Generatore: per ogni ticker, nell'ordine dei file delle borse, la lista dei suoi record, al più uno per anno
+    # (letti dal DB per chiave symbol/anno: niente da deduplicare; lo fa get_all_financial_data sull'insieme).
+    # I download (anni mancanti, o anche scaduti con force_refresh) partono a blocchi di chunk_size ticker
+    # e vengono salvati nel DB dal coordinatore man mano: la memoria resta costante e chi consuma
+    # (es. compute_kpis sul singolo blocco) può iniziare subito
+    years = years or ALL_YEARS
+    coordinator = get_fetch_coordinator()
+    for exchange, filename in read_exchanges(exchanges_file).items():
+        companies = [c for c in read_companies(filename) if (c.get('ticker') or '').strip()]
+        for start in range(0, len(companies), chunk_size):
+            chunk = companies[start:start + chunk_size]
+            symbols = [c['ticker'].strip() for c in chunk]
+            plan = plan_refresh(symbols, years, stale=force_refresh)
+            futures = {
+                symbol: coordinator.submit(symbol, plan[symbol], description=c.get('description'), stock_exchange=exchange, refresh=force_refresh)
+                for symbol, c in zip(symbols, chunk) if symbol in plan
+            }
 
+            # Attesa dei soli download del blocco, poi una query per tutti i suoi ticker
+            # (dal primario se qualcosa è appena stato salvato)
+            wait([f for year_futures in futures.values() for f in year_futures])
+            db_rows = load_many_from_db(symbols, years, primary=bool(futures))
+            for symbol, company in zip(symbols, chunk):
+                records = [db_rows[(symbol, int(year))] for year in years if db_rows.get((symbol, int(year)))]
+                for record in records:
+                    record['description'] = company.get('description')
+                    record['stock_exchange'] = exchange
+                yield records
 
 
 def get_all_financial_data(force_refresh=True):
-    exchanges = read_exchanges('exchanges.txt')
-    financial_data = []
-
-    for exchange in exchanges.values():
-        companies = read_companies(exchange)
-        for company in companies:
-            symbol = company['ticker']
-            description = company['description']
-            stock_exchange = exchange
-
-            data_list = get_financial_data(
-                symbol, ['2021', '2022', '2023', '2024'],
-                force_refresh=force_refresh,
-                description=description,
-                stock_exchange=stock_exchange
-            )
-            #print(f"Fetched {len(data_list)} records for {symbol}")
-
-            for data in data_list:
-                if data is not None and isinstance(data, dict):
-                    data['description'] = description
-                    data['stock_exchange'] = stock_exchange
-                    financial_data.append(data)
-                #save_to_db(symbol, selected_years, data_list)
-            time.sleep(random.uniform(5, 9))
-
+    # Tutto l'universo in memoria, ordinato per (symbol, year). Per elaborazioni lunghe preferire
+    # iter_all_financial_data, che non accumula i record
+    if force_refresh:
+        # Download degli anni scaduti con checkpoint nel DB: dopo un'interruzione riprende
+        # dai ticker non completati invece che dal primo file delle borse
+        from full_refresh import run_full_refresh
+        run_full_refresh()
+
+    financial_data = [record for batch in iter_all_financial_data(force_refresh=False) for record in batch]
     financial_data = remove_duplicates(financial_data)
-    financial_data = [x for x in financial_data if 'symbol' in x and 'year' in x]
-
-    # Ordina se la lista è rimasta valida
-    if financial_data:
-        financial_data.sort(key=lambda x: (x['symbol'], x['year']))
-
-    #financial_data.sort(key=lambda x: (x['symbol'], x['year']))
+    financial_data.sort(key=lambda x: (x['symbol'], x['year']))
     return financial_data
 
 
-
-
 def compute_kpis(financial_data):
     import pandas as pd
     import numpy as np
@@ -273,7 +239,7 @@ def compute_kpis(financial_data):
                 return np.nan
 
         # Se è un dizionario singolo, lo trasformiamo in lista per DataFrame
-        if isinstance(financial_data, dict):
+        if isinstance(financial_data, Mapping):
             financial_data = [financial_data]
 
         df = pd.DataFrame(financial_data)
@@ -336,16 +302,23 @@ def compute_kpis(financial_data):
         return pd.DataFrame()
 
 
-def get_or_fetch_data(symbol, years, description, stock_exchange):
+def get_or_fetch_data(symbol, years, description, stock_exchange, columns=None):
+    # columns: se indicato, i record contengono solo questi campi (più symbol, year, description e
+    # stock_exchange), letti dal DB senza decodificare l'intero payload
     print(f"get_or_fetch_data chiamata per {symbol} anni {years}", flush=True)
-    db_data = load_from_db(symbol, years)
+    record_view(symbol)
+    if columns:
+        db_rows = load_many_columns([symbol], years, columns)
+        db_data = [db_rows.get((symbol, int(year))) for year in years]
+    else:
+        db_data = load_from_db(symbol, years)
 
     final_data = []
     years_to_fetch = []
 
     for i, year in enumerate(years):
         record = db_data[i]
-        if isinstance(record, dict) and record:
+        if isinstance(record, Mapping) and record:
             print(f"Dati da DB per {symbol} anno {year} trovati.", flush=True)
             record['description'] = description
             record['stock_exchange'] = stock_exchange
@@ -355,33 +328,34 @@ def get_or_fetch_data(symbol, years, description, stock_exchange):
             years_to_fetch.append(year)
 
     if years_to_fetch:
-        print(f"Scarico dati per {symbol} anni: {years_to_fetch}", flush=True)
-        fetched_data = get_financial_data(symbol, years_to_fetch, description=description, stock_exchange=stock_exchange)
+        missing = known_missing([symbol], years_to_fetch)
+        if missing:
+            print(f"Nessun dato alla fonte per {symbol} anni {sorted(y for _, y in missing)} (cache negativa), salto il download", flush=True)
+            years_to_fetch = [year for year in years_to_fetch if (symbol, int(year)) not in missing]
 
-        valid_data = []
+    if years_to_fetch:
+        print(f"Scarico dati per {symbol} anni: {years_to_fetch}", flush=True)
+        # Download e salvataggio nel pool del coordinatore: richieste concorrenti per gli stessi anni
+        # condividono un solo download. Il risultato è allineato a years_to_fetch
+        fetched_data = get_fetch_coordinator().fetch(symbol, years_to_fetch, description=description, stock_exchange=stock_exchange)
 
         for i, data in enumerate(fetched_data):
-            if isinstance(data, dict) and data:
+            if isinstance(data, Mapping) and data:
                 data_year = data.get("year")
                 expected_year = years_to_fetch[i]
 
-                if data_year == expected_year:
+                if str(data_year) == str(expected_year):
                     print(f"Dati scaricati validi per {symbol} anno {expected_year}", flush=True)
+                    if columns:
+                        data = FinancialRecord((c, data.get(c)) for c in ['symbol', 'year', *columns])
                     data['description'] = description
                     data['stock_exchange'] = stock_exchange
                     final_data.append(data)
-                    valid_data.append(data)
                 else:
                     print(f"⚠️ ATTENZIONE: Anno nei dati = {data_year}, ma ci si aspettava {expected_year}. Dato SCARTATO.", flush=True)
             else:
                 print(f"Dati scaricati NON validi per {symbol} anno {years_to_fetch[i]}", flush=True)
 
-        if valid_data:
-            print(f"Salvo dati nuovi nel DB per {symbol} anni {[d['year'] for d in valid_data]}", flush=True)
-            save_to_db(symbol, [d['year'] for d in valid_data], valid_data)
-        else:
-            print(f"Nessun dato valido da salvare per {symbol}", flush=True)
-
     return final_data
 
 
@@ -0,0 +1,148 @@
+import os
+import time
+import logging
+import threading
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+logger = logging.getLogger("db_engine")
+
+# Creazione degli engine SQLAlchemy con pool e impostazioni per backend, configurabili da ambiente:
+#   DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT (s), DB_POOL_RECYCLE (s), DB_STATEMENT_TIMEOUT_MS (Postgres),
+#   SQLITE_PROFILE ("performance" o "default"), SQLITE_BUSY_TIMEOUT_MS, SQLITE_MMAP_SIZE_MB, SQLITE_CACHE_MB (SQLite)
+# Il pool registra connessioni in uso, overflow e thread in attesa: vedi pool_metrics()
+
+POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 30))
+# Le connessioni più vecchie vengono riaperte: evita quelle chiuse lato server/proxy per inattività
+POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+STATEMENT_TIMEOUT_MS = int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", 30000))
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", 5000))
+SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE_MB", 256)) * 1024 * 1024
+SQLITE_CACHE_SIZE = int(os.environ.get("SQLITE_CACHE_MB", 64)) * 1024
+SQLITE_PROFILE = os.environ.get("SQLITE_PROFILE", "performance")
+# VACUUM in manutenzione solo se le pagine libere superano questa frazione del file
+SQLITE_VACUUM_FREE_RATIO = float(os.environ.get("SQLITE_VACUUM_FREE_RATIO", 0.2))
+
+# PRAGMA applicati a ogni nuova connessione SQLite (busy_timeout sempre).
+# performance: WAL (i lettori non bloccano lo scrittore e viceversa), synchronous=NORMAL (in WAL resta
+# consistente dopo un crash; si possono perdere solo gli ultimi commit in caso di blackout),
+# cache di pagine più grande (valore negativo = KiB), I/O mappato in memoria, tabelle temporanee in RAM
+SQLITE_PROFILES = {
+    "default": {},
+    "performance": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -SQLITE_CACHE_SIZE,
+        "mmap_size": SQLITE_MMAP_SIZE,
+        "temp_store": "MEMORY",
+    },
+}
+
+
+class MeteredQueuePool(QueuePool):
+    # QueuePool che conta i thread in attesa di una connessione, i timeout e l'attesa massima
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._metrics_lock = threading.Lock()
+        self.waiting = 0
+        self.timeouts = 0
+        self.max_wait = 0.0
+
+    def _do_get(self):
+        # Attesa solo se il pool è esaurito (max_overflow=-1: overflow illimitato, nessuna attesa)
+        exhausted = self._max_overflow > -1 and self.checkedout() >= self.size() + self._max_overflow
+        if not exhausted:
+            return super()._do_get()
+        started = time.monotonic()
+        with self._metrics_lock:
+            self.waiting += 1
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            with self._metrics_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.monotonic() - started
+            with self._metrics_lock:
+                self.waiting -= 1
+                self.max_wait = max(self.max_wait, waited)
+
+
+def sqlite_pragmas(profile):
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+            for name, value in SQLITE_PROFILES[profile].items():
+                cursor.execute(f"PRAGMA {name}={value}")
+        finally:
+            cursor.close()
+    return on_connect
+
+
+def make_engine(url, sqlite_profile=SQLITE_PROFILE):
+    # Engine per l'URL indicato con le impostazioni del backend
+    backend = make_url(url).get_backend_name()
+    pool_args = {
+        "poolclass": MeteredQueuePool,
+        "pool_size": POOL_SIZE,
+        "max_overflow": MAX_OVERFLOW,
+        "pool_timeout": POOL_TIMEOUT,
+        "pool_recycle": POOL_RECYCLE,
+    }
+
+    if backend == "sqlite":
+        engine = create_engine(url, connect_args={
+            "check_same_thread": False,
+            "timeout": SQLITE_BUSY_TIMEOUT_MS / 1000,
+        }, **pool_args)
+        event.listen(engine, "connect", sqlite_pragmas(sqlite_profile))
+    elif backend == "postgresql":
+        connect_args = {"options": f"-c statement_timeout={STATEMENT_TIMEOUT_MS}"} if STATEMENT_TIMEOUT_MS else {}
+        engine = create_engine(url, pool_pre_ping=True, connect_args=connect_args, **pool_args)
+    else:
+        engine = create_engine(url, pool_pre_ping=True, **pool_args)
+
+    logger.info(f"Engine {backend}: {sqlite_profile + ', ' if backend == 'sqlite' else ''}pool_size={POOL_SIZE} max_overflow={MAX_OVERFLOW} recycle={POOL_RECYCLE}s")
+    return engine
+
+
+def pool_metrics(engine):
+    # Stato del pool: dimensione, connessioni in uso/libere, overflow, thread in attesa, timeout, attesa massima (s)
+    pool = engine.pool
+    metrics = {
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "checked_in": pool.checkedin(),
+        "overflow": max(pool.overflow(), 0),
+    }
+    if isinstance(pool, MeteredQueuePool):
+        metrics.update(waiting=pool.waiting, timeouts=pool.timeouts, max_wait=round(pool.max_wait, 3))
+    return metrics
+
+
+def maintain_sqlite(engine, vacuum=None):
+    # Manutenzione periodica: ANALYZE aggiorna le statistiche del query planner, il checkpoint svuota il WAL,
+    # VACUUM (forzato, o se le pagine libere superano SQLITE_VACUUM_FREE_RATIO) ricompatta il file.
+    # Restituisce un dict con l'esito; None se il backend non è SQLite
+    if engine.dialect.name != "sqlite":
+        return None
+    started = time.monotonic()
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.exec_driver_sql("ANALYZE")
+        pages = conn.exec_driver_sql("PRAGMA page_count").scalar()
+        free = conn.exec_driver_sql("PRAGMA freelist_count").scalar()
+        if vacuum is None:
+            vacuum = pages > 0 and free / pages > SQLITE_VACUUM_FREE_RATIO
+        if vacuum:
+            conn.exec_driver_sql("VACUUM")
+        conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+    result = {"pages": pages, "free_pages": free, "vacuum": vacuum, "seconds": round(time.monotonic() - started, 2)}
+    logger.info(f"Manutenzione SQLite: {result}")
+    return result
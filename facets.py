@@ -0,0 +1,148 @@
+import threading
+import logging
+
+from cache_db import load_facet_rows, load_company_exchanges, add_save_listener, get_data_version
+from data_utils import read_exchanges, sync_company_table
+
+logger = logging.getLogger("facets")
+
+# Elenco unico dei settori (nomi Yahoo Finance) usato dalle pagine quando l'indice è vuoto
+SECTORS_AVAILABLE = [
+    'Basic Materials', 'Communication Services', 'Consumer Cyclical', 'Consumer Defensive', 'Energy',
+    'Financial Services', 'Healthcare', 'Industrials', 'Real Estate', 'Technology', 'Utilities'
+]
+
+# Alias storici dei nomi settore -> nome usato da Yahoo Finance
+SECTOR_ALIASES = {
+    'Finance Services': 'Financial Services',
+}
+
+
+def normalize_sector(sector):
+    if sector is None:
+        return None
+    sector = str(sector).strip()
+    return SECTOR_ALIASES.get(sector, sector)
+
+
+class FacetIndex:
+    # Indice borsa x anno -> settore -> industria -> simboli, tenuto aggiornato ad ogni save_to_db.
+    # Le opzioni dei filtri e il filtro per settore/industria diventano lookup su insiemi.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._facets = {}
+        self._exchanges_by_symbol = {}
+        # Versione dei dati finanziari da cui è stato costruito
+        self.version = None
+
+    def build(self):
+        # Versione letta prima delle righe: un salvataggio concorrente porta a un'altra ricostruzione
+        version = get_data_version(('financials',))
+        facets = {}
+        for stock_exchange, year, sector, industry, symbol in load_facet_rows():
+            self._add(facets, stock_exchange, year, sector, industry, symbol)
+        exchanges_by_symbol = load_company_exchanges()
+        with self._lock:
+            self._facets = facets
+            self._exchanges_by_symbol = exchanges_by_symbol
+            self.version = version
+        logger.info(f"Indice faccette costruito: {len(facets)} combinazioni borsa/anno")
+        return self
+
+    @staticmethod
+    def _add(facets, stock_exchange, year, sector, industry, symbol):
+        sector = normalize_sector(sector) or 'N/A'
+        industry = industry or 'N/A'
+        by_sector = facets.setdefault((stock_exchange, int(year)), {})
+        by_sector.setdefault(sector, {}).setdefault(industry, set()).add(symbol)
+
+    @staticmethod
+    def _discard(facets, stock_exchange, year, symbol):
+        # Un simbolo compare in un solo settore/industria per borsa e anno: rimuove la voce precedente
+        by_sector = facets.get((stock_exchange, int(year)), {})
+        for sector in list(by_sector):
+            for industry in list(by_sector[sector]):
+                by_sector[sector][industry].discard(symbol)
+                if not by_sector[sector][industry]:
+                    del by_sector[sector][industry]
+            if not by_sector[sector]:
+                del by_sector[sector]
+
+    def on_save(self, symbol, saved, versions=None):
+        # Listener di cache_db.save_to_db: aggiornamento incrementale. Se l'indice era alla versione
+        # precedente il salvataggio, passa alla nuova: solo le scritture di altri processi lo ricostruiscono
+        with self._lock:
+            for stock_exchange in self._exchanges_by_symbol.get(symbol, ()):
+                for year, sector, industry in saved:
+                    self._discard(self._facets, stock_exchange, year, symbol)
+                    self._add(self._facets, stock_exchange, year, sector, industry, symbol)
+            if versions and self.version == versions[0]:
+                self.version = versions[1]
+
+    def _selected(self, exchanges, years):
+        keys = [(e, int(y)) for e in exchanges for y in years]
+        return [self._facets[k] for k in keys if k in self._facets]
+
+    def sectors(self, exchanges, years):
+        # settore -> numero di simboli distinti
+        with self._lock:
+            symbols = {}
+            for by_sector in self._selected(exchanges, years):
+                for sector, by_industry in by_sector.items():
+                    symbols.setdefault(sector, set()).update(*by_industry.values())
+        return {sector: len(s) for sector, s in sorted(symbols.items())}
+
+    def industries(self, exchanges, years, sectors=None):
+        # industria -> numero di simboli distinti (solo per i settori indicati, se presenti)
+        sectors = {normalize_sector(s) for s in sectors} if sectors else None
+        with self._lock:
+            symbols = {}
+            for by_sector in self._selected(exchanges, years):
+                for sector, by_industry in by_sector.items():
+                    if sectors and sector not in sectors:
+                        continue
+                    for industry, s in by_industry.items():
+                        symbols.setdefault(industry, set()).update(s)
+        return {industry: len(s) for industry, s in sorted(symbols.items())}
+
+    def symbols(self, exchanges, years, sectors=None, industries=None):
+        sectors = {normalize_sector(s) for s in sectors} if sectors else None
+        industries = set(industries) if industries else None
+        result = set()
+        with self._lock:
+            for by_sector in self._selected(exchanges, years):
+                for sector, by_industry in by_sector.items():
+                    if sectors and sector not in sectors:
+                        continue
+                    for industry, s in by_industry.items():
+                        if industries and industry not in industries:
+                            continue
+                        result.update(s)
+        return result
+
+    def outside_sectors(self, exchanges, years, sectors):
+        # Simboli indicizzati solo in settori diversi da quelli indicati: gli unici da poter saltare.
+        # Le aziende senza righe nel DB non sono nell'indice e vanno comunque scaricate e filtrate dopo
+        return self.symbols(exchanges, years) - self.symbols(exchanges, years, sectors)
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_facet_index(rebuild=False, exchanges_file='exchanges.txt'):
+    # Indice condiviso dal processo, registrato come listener dei salvataggi dello stesso processo.
+    # I salvataggi di altri processi (refresh_service, full_refresh, worker dei report) si vedono dalla
+    # versione dei dati: se non è quella già applicata dal listener l'indice viene ricostruito.
+    # Alla prima costruzione sincronizza la tabella aziende dai file delle borse
+    global _index
+    with _index_lock:
+        if _index is None:
+            sync_company_table(read_exchanges(exchanges_file))
+            _index = FacetIndex()
+            add_save_listener(_index.on_save)
+            rebuild = True
+        if rebuild or _index.version != get_data_version(('financials',)):
+            _index.build()
+        return _index
@@ -0,0 +1,159 @@
+import os
+import asyncio
+import logging
+import threading
+from collections.abc import Mapping
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+from cache_db import load_from_db, load_freshness, save_to_db, record_missing
+from data_sources import DataSource, get_data_source
+from financial_record import FinancialRecord, as_record
+
+logger = logging.getLogger("fetch_coordinator")
+
+# Download dei dati mancanti in un pool di thread, fuori dal thread dello script Streamlit.
+# Single-flight: se più sessioni chiedono lo stesso (symbol, anno) mentre il download è in corso,
+# attendono tutte lo stesso Future invece di scaricare e salvare due volte.
+
+FETCH_WORKERS = int(os.environ.get("FETCH_WORKERS", 4))
+# Attesa massima dei chiamanti sincroni (secondi); il download continua comunque in background
+FETCH_TIMEOUT = float(os.environ.get("FETCH_TIMEOUT", 300))
+
+
+def _copy(record):
+    # Ogni chiamante riceve la sua copia: lo stesso risultato è condiviso tra sessioni
+    return record.copy() if isinstance(record, FinancialRecord) else record
+
+
+class FetchCoordinator:
+    def __init__(self, max_workers=FETCH_WORKERS, source=None):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="fetch")
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._source = source
+        self.started = 0
+        self.coalesced = 0
+
+    def _download(self, symbol, years, description, stock_exchange):
+        # SourceError (errore temporaneo) arriva ai chiamanti come eccezione del Future e non finisce nella cache negativa
+        source = self._source or get_data_source()
+        fetch = source.fetch if isinstance(source, DataSource) else source
+        return fetch(symbol, years, description=description, stock_exchange=stock_exchange)
+
+    def submit(self, symbol, years, description=None, stock_exchange=None, refresh=False):
+        # Un Future per anno (risultato: dict dei dati o None); gli anni già in corso riusano il Future esistente.
+        # refresh=True riscarica anche gli anni già presenti nel DB
+        futures = []
+        new_years = []
+        with self._lock:
+            for year in years:
+                key = (symbol, int(year))
+                future = self._inflight.get(key)
+                if future is None:
+                    future = Future()
+                    self._inflight[key] = future
+                    new_years.append(year)
+                else:
+                    self.coalesced += 1
+                futures.append(future)
+            if new_years:
+                self.started += 1
+        if new_years:
+            own = {int(year): futures[years.index(year)] for year in new_years}
+            self._executor.submit(self._run, symbol, own, description, stock_exchange, refresh)
+        return futures
+
+    def _run(self, symbol, futures, description, stock_exchange, refresh=False):
+        # Anni come interi: i dati del DB e di Yahoo usano anni interi, le pagine spesso stringhe
+        years = list(futures)
+        results = {year: None for year in years}
+        error = None
+        try:
+            # Un'altra sessione o processo potrebbe averli appena salvati
+            cached = [None] * len(years) if refresh else load_from_db(symbol, years, primary=True)
+            missing = []
+            for year, record in zip(years, cached):
+                if record:
+                    results[year] = record
+                else:
+                    missing.append(year)
+            if missing:
+                logger.info(f"Scarico {symbol} anni {missing}")
+                valid = []
+                for data in self._download(symbol, missing, description, stock_exchange) or []:
+                    if isinstance(data, Mapping) and data and data.get("year") in missing and results[data["year"]] is None:
+                        data = as_record(data)
+                        results[data["year"]] = data
+                        valid.append(data)
+                if valid:
+                    save_to_db(symbol, [d["year"] for d in valid], valid)
+                # Anni senza dati alla fonte: nella cache negativa (save_to_db la ripulisce quando arrivano)
+                not_found = [year for year in missing if results[year] is None]
+                if not_found and refresh:
+                    # Con refresh gli anni già nel DB restano validi: non sono "assenti alla fonte"
+                    existing = load_freshness([symbol], not_found)
+                    not_found = [year for year in not_found if (symbol, year) not in existing]
+                if not_found:
+                    record_missing(symbol, not_found)
+        except Exception as e:
+            logger.warning(f"Errore download {symbol}: {e}")
+            error = e
+        finally:
+            with self._lock:
+                for year in years:
+                    self._inflight.pop((symbol, year), None)
+            for year, future in futures.items():
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(results[year])
+
+    def fetch(self, symbol, years, description=None, stock_exchange=None, timeout=FETCH_TIMEOUT, refresh=False):
+        # Versione bloccante: lista allineata a years (None per gli anni non disponibili o non arrivati in tempo)
+        futures = self.submit(symbol, years, description, stock_exchange, refresh)
+        wait(futures, timeout=timeout)
+        results = []
+        for year, future in zip(years, futures):
+            if not future.done():
+                logger.warning(f"Timeout download {symbol} anno {year}")
+                results.append(None)
+            elif future.exception() is not None:
+                results.append(None)
+            else:
+                results.append(_copy(future.result()))
+        return results
+
+    async def fetch_async(self, symbol, years, description=None, stock_exchange=None):
+        futures = self.submit(symbol, years, description, stock_exchange)
+        results = await asyncio.gather(*[asyncio.wrap_future(f) for f in futures], return_exceptions=True)
+        return [None if isinstance(r, BaseException) else _copy(r) for r in results]
+
+    def stats(self):
+        with self._lock:
+            return {"inflight": len(self._inflight), "started": self.started, "coalesced": self.coalesced}
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+_coordinator = None
+_coordinator_lock = threading.Lock()
+
+
+def get_fetch_coordinator():
+    global _coordinator
+    with _coordinator_lock:
+        if _coordinator is None:
+            _coordinator = FetchCoordinator()
+        return _coordinator
+
+
+def _reset_after_fork():
+    # Nel processo figlio (worker dei report, batch) i thread del pool non esistono: i Future in volo
+    # non si completerebbero mai. Il figlio crea un coordinatore proprio al primo uso
+    global _coordinator, _coordinator_lock
+    _coordinator = None
+    _coordinator_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,161 @@
+import numbers
+from array import array
+from collections.abc import Mapping, MutableMapping
+
+# Schema dei dati finanziari (una riga per symbol/anno) e record compatto che lo implementa.
+# FinancialRecord si usa come un dict (record["net_income"], .get, assegnazione, pd.DataFrame(records))
+# ma tiene i campi testuali in __slots__ e i campi numerici in un array di float64 a layout fisso:
+# circa un terzo della memoria di un dict con le stesse 40 chiavi. Chiavi fuori schema restano ammesse.
+
+# Ordine e tipi delle colonne dei dati finanziari
+FINANCIAL_COLUMNS = [
+    'symbol', 'description', 'sector', 'industry', 'stock_exchange', 'year',
+    'total_revenue', 'operating_revenue', 'cost_of_revenue', 'gross_profit',
+    'operating_expense', 'sg_and_a', 'r_and_d', 'operating_income',
+    'net_non_operating_interest_income_expense', 'interest_expense_non_operating',
+    'pretax_income', 'tax_provision', 'net_income_common_stockholders',
+    'net_income', 'net_income_continuous_operations', 'basic_eps', 'diluted_eps',
+    'basic_average_shares', 'diluted_average_shares', 'total_expenses',
+    'normalized_income', 'interest_expense', 'net_interest_income',
+    'ebit', 'ebitda', 'reconciled_depreciation', 'normalized_ebitda',
+    'total_assets', 'stockholders_equity', 'free_cash_flow', 'changes_in_cash',
+    'working_capital', 'invested_capital', 'total_debt'
+]
+TEXT_COLUMNS = ['symbol', 'description', 'sector', 'industry', 'stock_exchange']
+NUMERIC_COLUMNS = [c for c in FINANCIAL_COLUMNS if c not in TEXT_COLUMNS and c != 'year']
+
+_SCALAR_FIELDS = tuple(TEXT_COLUMNS) + ('year',)
+_SCALAR_SET = frozenset(_SCALAR_FIELDS)
+_NUMERIC_INDEX = {name: i for i, name in enumerate(NUMERIC_COLUMNS)}
+_NAN = float('nan')
+_EMPTY_VALUES = array('d', [_NAN]) * len(NUMERIC_COLUMNS)
+# Segnaposto per i campi testuali non valorizzati (distinti da quelli valorizzati a None)
+_UNSET = object()
+
+
+def _is_number(value):
+    kind = type(value)
+    if kind is float or kind is int:
+        return True
+    return kind is not bool and isinstance(value, numbers.Real)
+
+
+class FinancialRecord(MutableMapping):
+    # _mask: bit i acceso se NUMERIC_COLUMNS[i] è valorizzato (None è salvato come NaN);
+    # _extra: dict delle chiavi fuori schema, creato solo se serve
+    __slots__ = _SCALAR_FIELDS + ('_mask', '_values', '_extra')
+
+    def __init__(self, data=None, **fields):
+        for name in _SCALAR_FIELDS:
+            setattr(self, name, _UNSET)
+        self._extra = None
+        mask = 0
+        values = self._values = array('d', _EMPTY_VALUES)
+        if data is not None:
+            for key, value in (data.items() if isinstance(data, Mapping) else data):
+                # Percorso diretto per i float/int dei campi numerici, i più frequenti
+                i = _NUMERIC_INDEX.get(key)
+                kind = type(value)
+                if i is not None and (kind is float or kind is int or value is None):
+                    values[i] = _NAN if value is None else value
+                    mask |= 1 << i
+                else:
+                    self._mask = mask
+                    self[key] = value
+                    mask = self._mask
+        self._mask = mask
+        for key, value in fields.items():
+            self[key] = value
+
+    def __getitem__(self, key):
+        i = _NUMERIC_INDEX.get(key)
+        if i is not None:
+            if self._mask >> i & 1:
+                value = self._values[i]
+                return None if value != value else value
+        elif key in _SCALAR_SET:
+            value = getattr(self, key)
+            if value is not _UNSET:
+                return value
+        if self._extra and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        i = _NUMERIC_INDEX.get(key)
+        if i is not None:
+            if value is None or _is_number(value):
+                self._values[i] = _NAN if value is None else float(value)
+                self._mask |= 1 << i
+                if self._extra:
+                    self._extra.pop(key, None)
+                return
+            # Valore non numerico in un campo numerico (righe anomale): conservato com'è
+            self._mask &= ~(1 << i)
+        elif key in _SCALAR_SET:
+            setattr(self, key, value)
+            return
+        if self._extra is None:
+            self._extra = {}
+        self._extra[key] = value
+
+    def __delitem__(self, key):
+        i = _NUMERIC_INDEX.get(key)
+        if i is not None and self._mask >> i & 1:
+            self._mask &= ~(1 << i)
+            return
+        if key in _SCALAR_SET and getattr(self, key) is not _UNSET:
+            setattr(self, key, _UNSET)
+            return
+        if self._extra and key in self._extra:
+            del self._extra[key]
+            return
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        for name in _SCALAR_FIELDS:
+            if getattr(self, name) is not _UNSET:
+                yield name
+        mask = self._mask
+        for i, name in enumerate(NUMERIC_COLUMNS):
+            if mask >> i & 1:
+                yield name
+        if self._extra:
+            yield from self._extra
+
+    def __len__(self):
+        scalars = sum(1 for name in _SCALAR_FIELDS if getattr(self, name) is not _UNSET)
+        return scalars + bin(self._mask).count('1') + len(self._extra or ())
+
+    def copy(self):
+        record = FinancialRecord.__new__(FinancialRecord)
+        for name in _SCALAR_FIELDS:
+            setattr(record, name, getattr(self, name))
+        record._mask = self._mask
+        record._values = array('d', self._values)
+        record._extra = dict(self._extra) if self._extra else None
+        return record
+
+    def __copy__(self):
+        return self.copy()
+
+    def __reduce__(self):
+        # Pickle (st.cache_data, processi dei report) come dict: indipendente dal layout interno
+        return (FinancialRecord, (dict(self),))
+
+    def __repr__(self):
+        return f"FinancialRecord({dict(self)!r})"
+
+
+def as_record(data):
+    # dict (o altro Mapping) -> FinancialRecord; None e record già compatti passano invariati
+    if data is None or isinstance(data, FinancialRecord):
+        return data
+    return FinancialRecord(data)
@@ -0,0 +1,129 @@
+import os
+import time
+import logging
+import argparse
+import datetime
+from concurrent.futures import wait
+from sqlalchemy.exc import IntegrityError
+
+from cache_db import (create_refresh_run, load_refresh_run, pending_run_items, mark_run_items,
+                      refresh_run_progress, reset_failed_run_items, mark_refresh)
+from data_utils import read_exchanges, read_companies
+from fetch_coordinator import get_fetch_coordinator
+from refresh_planner import plan_refresh
+
+logger = logging.getLogger("full_refresh")
+
+# Aggiornamento di tutti i ticker di tutte le borse con checkpoint nel DB (refresh_runs / refresh_run_items):
+# dopo un crash o un riavvio riparte dai ticker non ancora completati. Il lavoro si divide in shard
+# per hash del simbolo, uno per processo o macchina; gli shard devono condividere lo stesso --run-id:
+#   python full_refresh.py [--run-id ID] [--shard K/N] [--batch B] [--retry-failed] [--status]
+
+YEARS = ['2021', '2022', '2023', '2024']
+FULL_REFRESH_BATCH = int(os.environ.get("FULL_REFRESH_BATCH", 20))
+
+
+def universe_items(exchanges_file='exchanges.txt'):
+    # (symbol, borsa, descrizione) nell'ordine dei file delle borse
+    items = []
+    for exchange, filename in read_exchanges(exchanges_file).items():
+        seen = set()
+        for company in read_companies(filename):
+            symbol = (company.get('ticker') or '').strip()
+            if symbol and symbol not in seen:
+                seen.add(symbol)
+                items.append((symbol, exchange, company.get('description')))
+    return items
+
+
+def open_run(run_id=None, years=None, exchanges_file='exchanges.txt'):
+    # Riprende l'esecuzione indicata (o l'ultima non conclusa), altrimenti ne crea una nuova; restituisce (run_id, anni)
+    run = load_refresh_run(run_id)
+    if run:
+        logger.info(f"Riprendo refresh run {run[0]}")
+        return run
+    run_id = run_id or datetime.datetime.utcnow().strftime("full-%Y%m%d-%H%M%S")
+    years = [str(y) for y in (years or YEARS)]
+    items = universe_items(exchanges_file)
+    try:
+        create_refresh_run(run_id, years, items)
+    except IntegrityError:
+        # Creato nel frattempo da un altro shard con lo stesso run_id
+        run = load_refresh_run(run_id)
+        if run is None:
+            raise
+        logger.info(f"Riprendo refresh run {run[0]} creato da un altro shard")
+        return run
+    logger.info(f"Nuovo refresh run {run_id}: {len(items)} ticker, anni {years}")
+    return run_id, years
+
+
+def process_batch(items, years):
+    # Scarica gli anni scaduti dei ticker del blocco in parallelo (ritmo deciso dal rate limiter della fonte)
+    coordinator = get_fetch_coordinator()
+    plan = plan_refresh(list({symbol for symbol, _, _ in items}), years)
+    futures = {}
+    for symbol, exchange, description in items:
+        if plan.get(symbol):
+            futures[(symbol, exchange)] = coordinator.submit(symbol, plan[symbol], description=description, stock_exchange=exchange, refresh=True)
+    wait([f for fs in futures.values() for f in fs])
+
+    results = []
+    for symbol, exchange, _ in items:
+        fs = futures.get((symbol, exchange), [])
+        errors = [str(f.exception()) for f in fs if f.exception() is not None]
+        records = sum(1 for f in fs if f.exception() is None and f.result())
+        if fs and not errors:
+            mark_refresh(symbol, ok=True)
+        results.append((symbol, exchange, 'failed' if errors else 'done', records, errors[0] if errors else None))
+    return results
+
+
+def run_full_refresh(run_id=None, shard=0, shards=1, batch_size=FULL_REFRESH_BATCH, retry_failed=False, exchanges_file='exchanges.txt'):
+    # Elabora i ticker in sospeso del proprio shard, un checkpoint per blocco; restituisce i conteggi per stato.
+    # Con più shard il run_id è obbligatorio: shard avviati insieme creerebbero run separati sull'intero universo
+    if shards > 1 and not run_id:
+        raise ValueError("Con più shard serve un run_id condiviso (--run-id)")
+    run_id, years = open_run(run_id, exchanges_file=exchanges_file)
+    if retry_failed:
+        logger.info(f"Rimessi in coda {reset_failed_run_items(run_id)} ticker falliti")
+    started = logged = time.time()
+    processed = 0
+    while True:
+        items = pending_run_items(run_id, shard, shards, batch_size)
+        if not items:
+            break
+        mark_run_items(run_id, process_batch(items, years))
+        processed += len(items)
+        if time.time() - logged > 30:
+            logged = time.time()
+            logger.info(f"Run {run_id} shard {shard}/{shards}: {processed} ticker in {logged - started:.0f} s")
+    counts = refresh_run_progress(run_id)
+    logger.info(f"Run {run_id} shard {shard}/{shards} terminato: {counts}")
+    return counts
+
+
+def parse_shard(value):
+    shard, shards = (int(x) for x in value.split('/'))
+    if not 0 <= shard < shards:
+        raise argparse.ArgumentTypeError(f"Shard non valido: {value} (atteso K/N con 0 <= K < N)")
+    return shard, shards
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Aggiornamento completo ripristinabile dei dati finanziari")
+    parser.add_argument('--run-id', help="esecuzione da riprendere o creare (default: ultima non conclusa o nuova)")
+    parser.add_argument('--shard', type=parse_shard, default=(0, 1), help="shard K/N da elaborare (default: 0/1)")
+    parser.add_argument('--batch', type=int, default=FULL_REFRESH_BATCH, help="ticker per checkpoint")
+    parser.add_argument('--retry-failed', action='store_true', help="rimette in coda i ticker falliti")
+    parser.add_argument('--status', action='store_true', help="mostra solo l'avanzamento")
+    args = parser.parse_args()
+
+    if args.status:
+        run = load_refresh_run(args.run_id)
+        print(f"{run[0]}: {refresh_run_progress(run[0])}" if run else "Nessun refresh run aperto")
+    else:
+        shard, shards = args.shard
+        if shards > 1 and not args.run_id:
+            parser.error("--shard K/N con N > 1 richiede --run-id, lo stesso per tutti gli shard")
+        run_full_refresh(args.run_id, shard, shards, args.batch, args.retry_failed)
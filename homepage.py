@@ -179,7 +179,7 @@ def load_ticker_bar_data():
     for t in sampled:
         y = random.choice(years)
         data = load_from_db(t, [y])
-        if data and isinstance(data[0], dict):
+        if data and data[0]:
             d = data[0]
             key, label, _ = random.choice(kpi_fields)
             val = d.get(key)
@@ -1,14 +1,15 @@
 import streamlit as st
 import pandas as pd
-from data_utils import read_exchanges, read_companies, get_financial_data, remove_duplicates, get_or_fetch_data, add_meta_tags
-from cache_db import save_to_db, load_from_db, load_many_from_db
+from data_utils import read_exchanges, read_companies, get_financial_data, get_or_fetch_data, add_meta_tags
+from data_utils import typed_financial_frame
+from cache_db import save_to_db, load_from_db, query_financials, count_financials
+from facets import get_facet_index, SECTORS_AVAILABLE
 import base64
 import os
 import io
 from xlsxwriter import Workbook
 from PIL import Image
 #from pages import Graph, Who_we_are
-import copy
 
 
 st.set_page_config(page_title="Financials", layout="wide")
@@ -64,9 +65,7 @@ st.title("📊 Financial Data")
 exchanges = read_exchanges('exchanges.txt')
 exchange_names = list(exchanges.keys())
 years_available = ['2021', '2022', '2023', '2024']
-sectors_available = ['Communication Services', 'Consumer Cyclical', 'Consumer Defensive', 'Energy', 'Financial Services', 'Healthcare', 'Industrials', 'Real Estate', 'Technology', 'Utilities']
 
-financial_data = []
 selected_years = ['2023']
 selected_exchanges = ['NASDAQ']
 selected_sectors = []
@@ -77,8 +76,14 @@ with col1:
     selected_years = st.multiselect("Select Years", years_available, default=selected_years)
 with col2:
     selected_exchanges = st.multiselect("Select Stock Exchanges", exchange_names, default=selected_exchanges)
+
+# Indice del processo: costruito alla prima richiesta, ricostruito se altri processi hanno salvato dati
+facet_index = get_facet_index()
+sector_counts = facet_index.sectors(selected_exchanges, selected_years)
+sectors_available = list(sector_counts) or SECTORS_AVAILABLE
+
 with col3:
-    selected_sectors = st.multiselect("Select Sector", sectors_available)
+    selected_sectors = st.multiselect("Select Sector", sectors_available, format_func=lambda s: f"{s} ({sector_counts[s]})" if s in sector_counts else s)
 
 
 if st.button("Reset Filters"):
@@ -113,95 +118,42 @@ currency_messages = {
 
 st.markdown(f"<div class='currency-info'>{currency_messages.get(currency, 'Numbers reported are in billions of the local currency.')}</div>", unsafe_allow_html=True)
 
-use_cache = True
-
-financial_data = []
-for exchange in selected_exchanges:
-    companies = read_companies(exchanges[exchange])
-    symbols = [c['ticker'] for c in companies]
-    symbol_to_company = {c['ticker']: c for c in companies}
-
-    print(f"Carico dati dal DB per {len(symbols)} simboli su {exchange}...")
-    db_data = load_many_from_db(symbols, selected_years)
-    print(f"Caricati dal DB: {len(db_data)} record")
-
-    for k, v in list(db_data.items())[:5]:
-        print(f"DB record esempio: {k} keys={list(v.keys()) if v else None}")
-
-    for symbol in symbols:
-        company = symbol_to_company[symbol]
-        description = company.get('description', '')
-        stock_exchange = exchange
-
-        data_list = []
-        missing_years = []
+industry_counts = facet_index.industries(selected_exchanges, selected_years, selected_sectors)
+industries_available = list(industry_counts)
 
-        for year in selected_years:
-            y = int(year)
-            data = db_data.get((symbol, y))
-            if data:
-                data_copy = copy.deepcopy(data)
-                data_copy['description'] = description
-                data_copy['stock_exchange'] = stock_exchange
-                data_list.append(data_copy)
-            else:
-                missing_years.append(y)
-                data_list.append(None)
+# Mostra il multiselect per l'industria con le opzioni basate sulle industrie disponibili
+with col4:
+    selected_industries = st.multiselect("Select Industry", industries_available, default=selected_industries, format_func=lambda i: f"{i} ({industry_counts[i]})")
 
-        if not use_cache and missing_years:
-            print(f"Fetch dati mancanti per {symbol}: anni {missing_years}", flush=True)
-            fetched_data = get_or_fetch_data(symbol, missing_years, description, stock_exchange)
-            # NON serve save_to_db qui perché già fatto dentro get_or_fetch_data
-            for i, year in enumerate(selected_years):
-                if data_list[i] is None and year in missing_years:
-                    idx = missing_years.index(year)
-                    data_list[i] = fetched_data[idx]
+sort_labels = {'symbol': 'Ticker', 'description': 'Company Name', 'sector': 'Sector', 'industry': 'Industry', 'stock_exchange': 'Exchange', 'year': 'Year'}
 
-        financial_data.extend([d for d in data_list if d is not None])
+col5, col6, col7, col8 = st.columns([2, 1, 1, 1])
+with col5:
+    search_text = st.text_input("Search company or ticker", "")
+with col6:
+    sort_by = st.selectbox("Sort by", list(sort_labels), format_func=sort_labels.get)
+with col7:
+    sort_ascending = st.selectbox("Order", ["Ascending", "Descending"]) == "Ascending"
+with col8:
+    page_size = st.selectbox("Rows per page", [50, 100, 250, 500], index=1)
 
-print(f"Totale dati caricati in financial_data: {len(financial_data)}")
-print("Esempio dati caricati:", financial_data[:3])
+filters = dict(
+    exchanges=selected_exchanges, years=selected_years, sectors=selected_sectors,
+    industries=selected_industries, search=search_text
+)
 
+# Un solo COUNT per esecuzione: serve prima della query per limitare la pagina, che lo riceve già calcolato
+total = count_financials(**filters)
+page_count = max(1, -(-total // page_size))
+page = min(int(st.number_input(f"Page (of {page_count})", min_value=1, max_value=page_count, value=1, step=1)), page_count)
 
+page_frame, total = query_financials(sort_by=sort_by, ascending=sort_ascending, page=page, page_size=page_size, total=total, **filters)
+df = typed_financial_frame(page_frame) if not page_frame.empty else page_frame
 
-financial_data = remove_duplicates(financial_data)
-if selected_sectors:
-    industries_available = list(set(d['industry'] for d in financial_data if 'industry' in d and d['sector'] in selected_sectors))
-else:
-    industries_available = list(set(d['industry'] for d in financial_data if 'industry' in d))
 
-# Mostra il multiselect per l'industria con le opzioni basate sulle industrie disponibili
-with col4:
-    selected_industries = st.multiselect("Select Industry", industries_available, default=selected_industries)
-
-
-if selected_sectors:
-    financial_data = [d for d in financial_data if d.get('sector') in selected_sectors]
-if selected_industries:
-    financial_data = [d for d in financial_data if d.get('industry') in selected_industries]
-
-financial_data = [x for x in financial_data if isinstance(x, dict) and 'symbol' in x and 'year' in x]
-financial_data.sort(key=lambda x: (x['symbol'], x['year']))
-
-
-if financial_data:
-    df = pd.DataFrame(financial_data)
-    column_order = [
-    'symbol', 'description', 'sector', 'industry', 'stock_exchange', 'year',
-    'total_revenue', 'operating_revenue', 'cost_of_revenue', 'gross_profit',
-    'operating_expense', 'sg_and_a', 'r_and_d', 'operating_income',
-    'net_non_operating_interest_income_expense', 'interest_expense_non_operating',
-    'pretax_income', 'tax_provision', 'net_income_common_stockholders',
-    'net_income', 'net_income_continuous_operations', 'basic_eps', 'diluted_eps',
-    'basic_average_shares', 'diluted_average_shares', 'total_expenses',
-    'normalized_income', 'interest_expense', 'net_interest_income',
-    'ebit', 'ebitda', 'reconciled_depreciation', 'normalized_ebitda',
-    'total_assets', 'stockholders_equity', 'free_cash_flow', 'changes_in_cash',
-    'working_capital', 'invested_capital', 'total_debt'
-    ]
-
-    df = df[column_order]  # applica l'ordine delle colonne
-    st.success(f"{len(df)} records loaded.")
+if not df.empty:
+    first_row = (page - 1) * page_size + 1
+    st.success(f"{total} records found. Showing {first_row}-{first_row + len(df) - 1}.")
     COLUMN_LABELS = {
     "symbol": "Ticker",
     "sector": "Sector",
@@ -245,20 +197,25 @@ if financial_data:
     "total_debt": "Total Debt"
     }
 
-    df.rename(columns=COLUMN_LABELS, inplace=True)
-
-    # Crea un buffer per il file Excel
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        df.to_excel(writer, index=False, sheet_name='Financials')
-    excel_data = output.getvalue()
-
-    st.download_button(
-        label="Download Excel",
-        data=excel_data,
-        file_name="financial_data.xlsx",
-        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-    )
+    df = df.rename(columns=COLUMN_LABELS)
+
+    # L'export Excel carica tutte le righe filtrate solo su richiesta
+    if st.button("Prepare Excel export"):
+        full_frame, _ = query_financials(sort_by=sort_by, ascending=sort_ascending, page_size=None, total=total, **filters)
+        export_df = typed_financial_frame(full_frame).rename(columns=COLUMN_LABELS)
+
+        # Crea un buffer per il file Excel
+        output = io.BytesIO()
+        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
+            export_df.to_excel(writer, index=False, sheet_name='Financials')
+        excel_data = output.getvalue()
+
+        st.download_button(
+            label="Download Excel",
+            data=excel_data,
+            file_name="financial_data.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        )
 
     st.dataframe(df, use_container_width=True)
     #st.dataframe(df.style.format(str), height=600)
@@ -122,7 +122,7 @@ def load_data_for_selection(selected_symbols, selected_years):
     # 🔄 Ricostruzione lista di dizionari per DataFrame
     data = []
     for (symbol, year), record in results.items():
-        if isinstance(record, dict) and record:
+        if record:
             record['symbol'] = symbol
             record['year'] = year
             data.append(record)
@@ -3,6 +3,8 @@ import pandas as pd
 import plotly.graph_objects as go
 from data_utils import read_exchanges, read_companies, get_financial_data, remove_duplicates, compute_kpis, add_meta_tags
 from data_utils import get_or_fetch_data 
+from facets import get_facet_index, SECTORS_AVAILABLE
+from search_index import get_search_index
 import os
 import base64
 import requests
@@ -47,7 +49,9 @@ exchanges = read_exchanges("exchanges.txt")
 exchange_names = ["All"] + list(exchanges.keys())
 
 years_available = ['2021', '2022', '2023', '2024']
-sectors_available = ['Communication Services', 'Consumer Cyclical', 'Consumer Defensive', 'Energy', 'Financial Services', 'Healthcare', 'Industrials', 'Real Estate', 'Technology', 'Utilities']
+# Campi letti dal DB: settore, EPS e gli input di EBITDA Margin, FCF Margin e Debt to Equity
+KPI_COLUMNS = ['sector', 'basic_eps', 'ebitda', 'free_cash_flow', 'total_revenue', 'total_debt', 'stockholders_equity']
+sectors_available = SECTORS_AVAILABLE
 
 # Layout filtri
 col1, col2, col3, col4 = st.columns([1.2, 1.5, 2.2, 2])
@@ -56,21 +60,26 @@ with col1:
 with col2:
     selected_exchange = st.selectbox("Exchange", exchange_names, index=0, key="exchange_select")
 
-# Carico lista aziende
-if selected_exchange == "All":
-    companies = []
-    for exch in exchanges.values():
-        companies.extend(read_companies(exch))
-else:
-    companies = read_companies(exchanges[selected_exchange])
+# Ricerca aziende: indice per ticker/descrizione, chiave univoca (ticker, exchange)
+@st.cache_resource
+def load_search_index():
+    return get_search_index()
 
-symbol_to_name = {c["ticker"]: c["description"] for c in companies}
-name_to_symbol = {v: k for k, v in symbol_to_name.items()}
-company_names = list(symbol_to_name.values())
+search_index = load_search_index()
 
 with col3:
-    selected_company_names = st.multiselect("Companies (up to 10)", options=sorted(company_names), max_selections=10, key="companies_select")
-    selected_symbols = [name_to_symbol[name] for name in selected_company_names]
+    search_query = st.text_input("Search companies", key="companies_search", placeholder="Ticker or company name")
+    search_exchanges = None if selected_exchange == "All" else [selected_exchange]
+    hits = [search_index.key(e) for e in search_index.search(search_query, limit=50, exchanges=search_exchanges)]
+    options = list(dict.fromkeys(st.session_state.get("companies_select", []) + hits))
+    selected_keys = st.multiselect("Companies (up to 10)", options=options, format_func=search_index.label, max_selections=10, key="companies_select")
+
+selected_companies = [c for c in (search_index.get(k) for k in selected_keys) if c is not None]
+selected_symbols = [c.ticker for c in selected_companies]
+
+# Nomi azienda per i grafici: se due aziende hanno lo stesso nome si aggiunge il ticker
+name_counts = pd.Series([c.description for c in selected_companies]).value_counts()
+symbol_to_name = {c.ticker: c.description if name_counts.get(c.description, 0) == 1 else f"{c.description} ({c.ticker})" for c in selected_companies}
 
 with col4:
     if selected_exchange == "All":
@@ -80,11 +89,17 @@ with col4:
 
 # Cache per dati settore
 @st.cache_data(ttl=3600)
-def load_all_sector_data(exchange_name, year, max_companies=100):
+def load_all_sector_data(exchange_name, year, sector=None, max_companies=100):
     """Carica tutti i dati di un exchange per calcolo settori"""
     try:
         exch_file = exchanges[exchange_name]
         all_companies = read_companies(exch_file)
+
+        # Con l'indice faccette si saltano le aziende già nel DB con un altro settore;
+        # quelle non ancora scaricate restano, il filtro per settore si applica dopo il caricamento
+        if sector:
+            skip_symbols = get_facet_index().outside_sectors([exchange_name], [year], [sector])
+            all_companies = [c for c in all_companies if c["ticker"] not in skip_symbols]
         
         all_data = []
         companies_processed = 0
@@ -95,7 +110,7 @@ def load_all_sector_data(exchange_name, year, max_companies=100):
                 
             desc = company.get("description", "")
             try:
-                data = get_or_fetch_data(company["ticker"], [year], desc, exchange_name)
+                data = get_or_fetch_data(company["ticker"], [year], desc, exchange_name, columns=KPI_COLUMNS)
                 if data:
                     all_data.extend(data)
                     companies_processed += 1
@@ -129,29 +144,20 @@ def load_all_sector_data(exchange_name, year, max_companies=100):
 financial_data = []
 used_exchanges = set()
 
-for symbol in selected_symbols:
-    desc = symbol_to_name.get(symbol, "")
-    if selected_exchange == "All":
-        for exch_name, exch_file in exchanges.items():
-            try:
-                data = get_or_fetch_data(symbol, [selected_year], desc, exch_name)
-                if data:
-                    financial_data.extend(data)
-                    used_exchanges.add(exch_name)
-                    break
-            except:
-                continue
-    else:
-        data = get_or_fetch_data(symbol, [selected_year], desc, selected_exchange)
-        if data:
-            financial_data.extend(data)
-            used_exchanges.add(selected_exchange)
+for company in selected_companies:
+    try:
+        data = get_or_fetch_data(company.ticker, [selected_year], company.description, company.exchange, columns=KPI_COLUMNS)
+    except Exception:
+        continue
+    if data:
+        financial_data.extend(data)
+        used_exchanges.add(company.exchange)
 
 # Carica dati completi per settore se necessario
 df_all_sector = pd.DataFrame()
 if selected_sector != "All" and selected_exchange != "All":
     with st.spinner(f"Loading {selected_sector} sector data from {selected_exchange}..."):
-        df_all_sector = load_all_sector_data(selected_exchange, selected_year)
+        df_all_sector = load_all_sector_data(selected_exchange, selected_year, selected_sector)
 
 if not financial_data:
     st.warning("No data available for the selected companies.")
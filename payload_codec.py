@@ -0,0 +1,126 @@
+import os
+import json
+import math
+import base64
+import struct
+import logging
+
+from financial_record import NUMERIC_COLUMNS
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+logger = logging.getLogger("payload_codec")
+
+# Serializzazione dei record finanziari nella colonna cache.data_json (testo).
+#   CACHE_PAYLOAD_FORMAT=json    JSON (orjson se installato, altrimenti json della libreria standard)
+#   CACHE_PAYLOAD_FORMAT=packed  "pk1:" + base64 di: maschera dei campi presenti, i campi numerici dello schema
+#                                come float64 in ordine fisso, JSON dei campi restanti (symbol, sector, ...)
+#   CACHE_PAYLOAD_FORMAT=msgpack "mp1:" + base64 di msgpack (richiede il pacchetto msgpack)
+# La lettura riconosce il formato dal prefisso: le righe JSON già salvate restano leggibili.
+# Con json i payload restano interrogabili lato SQL (json_extract), con packed no.
+
+NUMERIC_FIELDS = tuple(NUMERIC_COLUMNS)
+_NUMERIC_INDEX = {name: i for i, name in enumerate(NUMERIC_FIELDS)}
+_PACKED_HEADER = struct.Struct(f"<Q{len(NUMERIC_FIELDS)}d")
+_NAN = float("nan")
+
+
+def _dumps_json(data):
+    if orjson is not None:
+        return orjson.dumps(data).decode("utf-8")
+    return json.dumps(data, ensure_ascii=False, allow_nan=False)
+
+
+def _loads_json(payload):
+    if orjson is not None:
+        try:
+            return orjson.loads(payload)
+        except orjson.JSONDecodeError:
+            # Righe storiche con NaN/Infinity, che orjson non accetta
+            pass
+    return json.loads(payload)
+
+
+class JsonCodec:
+    name = "json"
+    prefix = ""
+
+    def encode(self, data):
+        return _dumps_json(data)
+
+    def decode(self, payload):
+        return _loads_json(payload)
+
+
+class PackedCodec:
+    # I valori numerici non float (es. stringhe in righe anomale) finiscono nella parte JSON
+    name = "packed"
+    prefix = "pk1:"
+
+    def encode(self, data):
+        mask = 0
+        values = [_NAN] * len(NUMERIC_FIELDS)
+        extra = {}
+        for key, value in data.items():
+            i = _NUMERIC_INDEX.get(key)
+            if i is not None and (value is None or type(value) in (float, int)):
+                mask |= 1 << i
+                values[i] = _NAN if value is None else float(value)
+            else:
+                extra[key] = value
+        raw = _PACKED_HEADER.pack(mask, *values) + _dumps_json(extra).encode("utf-8")
+        return self.prefix + base64.b64encode(raw).decode("ascii")
+
+    def decode(self, payload):
+        raw = base64.b64decode(payload[len(self.prefix):])
+        mask, *values = _PACKED_HEADER.unpack_from(raw)
+        data = _loads_json(raw[_PACKED_HEADER.size:])
+        for i, name in enumerate(NUMERIC_FIELDS):
+            if mask >> i & 1:
+                value = values[i]
+                data[name] = None if math.isnan(value) else value
+        return data
+
+
+class MsgpackCodec:
+    name = "msgpack"
+    prefix = "mp1:"
+
+    def encode(self, data):
+        return self.prefix + base64.b64encode(msgpack.packb(data)).decode("ascii")
+
+    def decode(self, payload):
+        return msgpack.unpackb(base64.b64decode(payload[len(self.prefix):]))
+
+
+CODECS = {codec.name: codec for codec in (JsonCodec(), PackedCodec(), MsgpackCodec())}
+_BY_PREFIX = [(codec.prefix, codec) for codec in CODECS.values() if codec.prefix]
+
+PAYLOAD_FORMAT = os.environ.get("CACHE_PAYLOAD_FORMAT", "json")
+if PAYLOAD_FORMAT not in CODECS:
+    raise ValueError(f"CACHE_PAYLOAD_FORMAT non valido: {PAYLOAD_FORMAT} (ammessi: {list(CODECS)})")
+if PAYLOAD_FORMAT == "msgpack" and msgpack is None:
+    raise ImportError("CACHE_PAYLOAD_FORMAT=msgpack richiede il pacchetto msgpack")
+
+
+def encode_payload(data, fmt=None):
+    # Record (dict già convertito con convert_numpy) -> testo per data_json
+    return CODECS[fmt or PAYLOAD_FORMAT].encode(data)
+
+
+def decode_payload(payload):
+    # Testo di data_json (qualsiasi formato) -> dict; i dict (colonne JSON di Postgres) sono copiati
+    if isinstance(payload, dict):
+        return dict(payload)
+    for prefix, codec in _BY_PREFIX:
+        if payload.startswith(prefix):
+            return codec.decode(payload)
+    return CODECS["json"].decode(payload)
@@ -0,0 +1,134 @@
+import os
+import time
+import random
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+# Controllo adattivo delle richieste verso una fonte esterna (AIMD, come il controllo di congestione TCP):
+# finché le risposte sono sane la concorrenza cresce di 1 ogni `limit` successi consecutivi,
+# a ogni segnale di throttling (429, payload vuoto) si dimezza e le nuove richieste attendono
+# un backoff esponenziale con jitter.
+
+OK = "ok"
+THROTTLED = "throttled"
+ERROR = "error"
+
+
+class AdaptiveRateLimiter:
+    def __init__(self, initial=1, min_limit=1, max_limit=4, min_interval=1.0,
+                 base_backoff=2.0, max_backoff=300.0, decrease=0.5, window=60.0):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.min_interval = min_interval
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.decrease = decrease
+        self.window = window
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._successes = 0
+        self._consecutive_throttles = 0
+        self._not_before = 0.0
+        self._last_start = 0.0
+        self._last_decrease = 0.0
+        self._completed = deque()
+        self.counts = {OK: 0, THROTTLED: 0, ERROR: 0}
+        self.waited = 0.0
+
+    def acquire(self):
+        # Blocca finché c'è uno slot libero, il backoff è scaduto ed è passato min_interval dall'ultima partenza
+        start = time.monotonic()
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                ready_at = max(self._not_before, self._last_start + self.min_interval)
+                if self._in_flight < int(self.limit) and now >= ready_at:
+                    break
+                timeout = ready_at - now if self._in_flight < int(self.limit) else None
+                self._cond.wait(timeout)
+            self._in_flight += 1
+            self._last_start = now
+            self.waited += now - start
+        return now
+
+    def release(self, outcome=OK, started=None):
+        # started: valore restituito da acquire. I throttling di richieste partite prima dell'ultima
+        # riduzione sono già stati "pagati" e non riducono di nuovo (una riduzione per finestra, come in TCP)
+        with self._cond:
+            self._in_flight -= 1
+            self.counts[outcome] += 1
+            now = time.monotonic()
+            self._completed.append(now)
+            if outcome == OK:
+                self._consecutive_throttles = 0
+                self._successes += 1
+                # Aumento additivo: +1 dopo un "giro" completo di successi al limite attuale
+                if self._successes >= int(self.limit):
+                    self.limit = min(self.max_limit, self.limit + 1)
+                    self._successes = 0
+            elif outcome == THROTTLED and (started is None or started >= self._last_decrease):
+                # Diminuzione moltiplicativa e pausa esponenziale
+                self._last_decrease = now
+                self._successes = 0
+                self._consecutive_throttles += 1
+                self.limit = max(self.min_limit, self.limit * self.decrease)
+                backoff = min(self.max_backoff, self.base_backoff * 2 ** (self._consecutive_throttles - 1))
+                self._not_before = max(self._not_before, now + backoff * random.uniform(0.8, 1.2))
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self):
+        # with limiter.slot() as report: ...; report(THROTTLED) per segnalare l'esito (default OK, ERROR su eccezione)
+        outcome = [OK]
+        started = self.acquire()
+        try:
+            yield lambda value: outcome.__setitem__(0, value)
+        except BaseException:
+            if outcome[0] == OK:
+                outcome[0] = ERROR
+            raise
+        finally:
+            self.release(outcome[0], started)
+
+    def metrics(self):
+        with self._cond:
+            now = time.monotonic()
+            while self._completed and now - self._completed[0] > self.window:
+                self._completed.popleft()
+            span = min(self.window, now - self._completed[0]) if self._completed else 0
+            return {
+                "limit": int(self.limit),
+                "in_flight": self._in_flight,
+                "requests_per_min": round(len(self._completed) / span * 60, 1) if span > 0 else 0.0,
+                "backoff_seconds": round(max(0.0, self._not_before - now), 1),
+                "waited_seconds": round(self.waited, 1),
+                **self.counts,
+            }
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(name):
+    # Un limitatore per fonte e per processo, configurabile da ambiente: <NAME>_MAX_CONCURRENCY, <NAME>_MIN_INTERVAL
+    with _limiters_lock:
+        if name not in _limiters:
+            prefix = name.upper()
+            _limiters[name] = AdaptiveRateLimiter(
+                max_limit=int(os.environ.get(f"{prefix}_MAX_CONCURRENCY", 4)),
+                min_interval=float(os.environ.get(f"{prefix}_MIN_INTERVAL", 1.0)),
+            )
+        return _limiters[name]
+
+
+def _reset_after_fork():
+    # Lock e richieste in volo del padre non valgono nel processo figlio: limitatori nuovi al primo uso
+    global _limiters, _limiters_lock
+    _limiters = {}
+    _limiters_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
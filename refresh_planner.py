@@ -0,0 +1,53 @@
+import os
+import datetime
+
+from cache_db import load_freshness, load_missing
+
+# Quali righe di FinancialCache riscaricare: ogni anno ha un TTL rispetto a fetched_at.
+# L'anno in corso (e le righe incomplete) cambiano spesso, gli anni chiusi quasi mai.
+# Le coppie (symbol, anno) senza dati alla fonte restano nella cache negativa per un TTL a parte.
+
+CURRENT_YEAR_TTL = datetime.timedelta(days=float(os.environ.get("REFRESH_TTL_CURRENT_DAYS", 1)))
+CLOSED_YEAR_TTL = datetime.timedelta(days=float(os.environ.get("REFRESH_TTL_CLOSED_DAYS", 30)))
+MISSING_CURRENT_YEAR_TTL = datetime.timedelta(days=float(os.environ.get("MISSING_TTL_CURRENT_DAYS", 1)))
+MISSING_CLOSED_YEAR_TTL = datetime.timedelta(days=float(os.environ.get("MISSING_TTL_CLOSED_DAYS", 7)))
+
+
+def year_ttl(year, status=None, today=None):
+    today = today or datetime.date.today()
+    if int(year) >= today.year or status == 'partial':
+        return CURRENT_YEAR_TTL
+    return CLOSED_YEAR_TTL
+
+
+def is_stale(year, fetched_at, status, now=None):
+    # Righe senza fetched_at (salvate prima delle colonne di freschezza) vanno sempre riverificate
+    now = now or datetime.datetime.utcnow()
+    if fetched_at is None:
+        return True
+    return now - fetched_at > year_ttl(year, status, now.date())
+
+
+def known_missing(symbols, years, now=None):
+    # (symbol, anno intero) per cui un download recente non ha trovato dati: inutile riprovare prima del TTL
+    now = now or datetime.datetime.utcnow()
+    ttl = {int(y): MISSING_CURRENT_YEAR_TTL if int(y) >= now.year else MISSING_CLOSED_YEAR_TTL for y in years}
+    return {key for key, checked_at in load_missing(symbols, years).items() if now - checked_at <= ttl[key[1]]}
+
+
+def plan_refresh(symbols, years, now=None, stale=True):
+    # symbol -> anni da scaricare (mancanti o scaduti, esclusa la cache negativa), nella forma in cui
+    # sono stati passati; i simboli senza niente da fare non compaiono. stale=False: solo i mancanti
+    now = now or datetime.datetime.utcnow()
+    freshness = load_freshness(symbols, years)
+    missing = known_missing(symbols, years, now)
+    plan = {}
+    for symbol in symbols:
+        for year in years:
+            # La cache negativa vale allo stesso modo per righe assenti e presenti
+            if (symbol, int(year)) in missing:
+                continue
+            row = freshness.get((symbol, int(year)))
+            if row is None or (stale and is_stale(year, row[0], row[1], now)):
+                plan.setdefault(symbol, []).append(year)
+    return plan
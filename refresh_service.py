@@ -0,0 +1,110 @@
+import os
+import logging
+import argparse
+import datetime
+from concurrent.futures import wait
+
+from cache_db import engine, ensure_refresh_targets, stale_symbols, mark_refresh, flush_views
+from data_utils import read_exchanges, sync_company_table
+from fetch_coordinator import get_fetch_coordinator
+from refresh_planner import plan_refresh
+from rate_limiter import get_rate_limiter
+from db_engine import pool_metrics, maintain_sqlite
+
+logger = logging.getLogger("refresh_service")
+
+# Servizio di aggiornamento periodico, da eseguire come processo separato dall'app Streamlit:
+#   python refresh_service.py [--interval MINUTI] [--batch N] [--once | --maintain]
+# Ogni giro esamina i simboli non verificati da REFRESH_MAX_AGE_DAYS giorni, più visti prima e poi
+# i più vecchi, e riscarica solo gli anni scaduti secondo refresh_planner.
+# Lo stato per simbolo è in refresh_state, il job APScheduler nella tabella apscheduler_jobs.
+
+YEARS = [2021, 2022, 2023, 2024]
+REFRESH_MAX_AGE = datetime.timedelta(days=float(os.environ.get("REFRESH_MAX_AGE_DAYS", 1)))
+REFRESH_INTERVAL_MINUTES = int(os.environ.get("REFRESH_INTERVAL_MINUTES", 30))
+REFRESH_BATCH = int(os.environ.get("REFRESH_BATCH", 50))
+# ANALYZE/VACUUM del DB SQLite locale (nessun effetto su Postgres)
+MAINTENANCE_INTERVAL_HOURS = int(os.environ.get("DB_MAINTENANCE_INTERVAL_HOURS", 24))
+# Backoff dopo fallimenti consecutivi: 1h, 2h, 4h, ... fino a 7 giorni
+MAX_BACKOFF = datetime.timedelta(days=7)
+
+
+def retry_delay(failures):
+    return min(datetime.timedelta(hours=2 ** max(failures - 1, 0)), MAX_BACKOFF)
+
+
+def refresh_batch(batch_size=REFRESH_BATCH):
+    # Un giro di aggiornamento; restituisce (aggiornati, falliti).
+    # I simboli con tutti gli anni ancora freschi sono solo marcati come verificati
+    flush_views()
+    ensure_refresh_targets()
+    targets = stale_symbols(REFRESH_MAX_AGE, batch_size)
+    coordinator = get_fetch_coordinator()
+    plan = plan_refresh([symbol for symbol, _, _ in targets], YEARS)
+    # Tutti i download del giro in coda insieme: quanti ne partono in parallelo lo decide il rate limiter
+    pending = {}
+    for symbol, description, stock_exchange in targets:
+        years = plan.get(symbol)
+        if years:
+            pending[symbol] = coordinator.submit(symbol, years, description=description, stock_exchange=stock_exchange, refresh=True)
+        else:
+            mark_refresh(symbol, ok=True)
+
+    refreshed = failed = 0
+    for symbol, futures in pending.items():
+        wait(futures)
+        if any(f.exception() is None and f.result() for f in futures):
+            # Solo qui, dopo aver riscaricato gli anni pianificati: i download su richiesta delle pagine
+            # non contano come aggiornamento del simbolo
+            mark_refresh(symbol, ok=True)
+            refreshed += 1
+        else:
+            errors = [str(f.exception()) for f in futures if f.exception() is not None]
+            mark_refresh(symbol, ok=False, error=errors[0] if errors else "Nessun dato scaricato", backoff=retry_delay)
+            failed += 1
+    logger.info(f"Refresh: {refreshed} aggiornati, {failed} falliti su {len(targets)}; fonte: {get_rate_limiter('yahoo').metrics()}; pool DB: {pool_metrics(engine)}")
+    return refreshed, failed
+
+
+def maintain_db():
+    maintain_sqlite(engine)
+
+
+def run_scheduler(interval_minutes=REFRESH_INTERVAL_MINUTES, batch_size=REFRESH_BATCH):
+    from apscheduler.schedulers.blocking import BlockingScheduler
+    from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+
+    scheduler = BlockingScheduler(jobstores={"default": SQLAlchemyJobStore(engine=engine)})
+    # Riferimento testuale: il job salvato nel DB resta valido anche se il modulo è avviato come __main__
+    scheduler.add_job(
+        "refresh_service:refresh_batch", "interval", minutes=interval_minutes, kwargs={"batch_size": batch_size},
+        id="refresh_stale", replace_existing=True, max_instances=1, coalesce=True,
+        next_run_time=datetime.datetime.now(),
+    )
+    scheduler.add_job(
+        "refresh_service:maintain_db", "interval", hours=MAINTENANCE_INTERVAL_HOURS,
+        id="maintain_db", replace_existing=True, max_instances=1, coalesce=True,
+    )
+    logger.info(f"Scheduler avviato: ogni {interval_minutes} minuti, {batch_size} simboli per giro")
+    try:
+        scheduler.start()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Aggiornamento periodico dei dati finanziari")
+    parser.add_argument("--interval", type=int, default=REFRESH_INTERVAL_MINUTES, help="minuti tra un giro e l'altro")
+    parser.add_argument("--batch", type=int, default=REFRESH_BATCH, help="simboli per giro")
+    parser.add_argument("--once", action="store_true", help="esegue un solo giro ed esce")
+    parser.add_argument("--maintain", action="store_true", help="esegue solo la manutenzione del DB (ANALYZE, VACUUM se serve) ed esce")
+    args = parser.parse_args()
+
+    if args.maintain:
+        maintain_sqlite(engine, vacuum=True)
+        raise SystemExit
+    sync_company_table(read_exchanges("exchanges.txt"))
+    if args.once:
+        refresh_batch(args.batch)
+    else:
+        run_scheduler(args.interval, args.batch)
@@ -0,0 +1,149 @@
+import io
+import os
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image, PageBreak, Table, TableStyle
+from reportlab.lib.styles import getSampleStyleSheet
+from reportlab.lib.pagesizes import A4
+from cache_db import load_many_from_db
+from data_utils import read_exchanges, read_companies, get_or_fetch_data
+from facets import get_facet_index, normalize_sector
+from report_charts import kpi_chart_png
+from report_stats import summary_stats, report_kpi_frame, report_comments, format_kpi_value
+
+# Costruzione del report PDF (usata dalla coda in background di report_jobs e da batch_reports).
+# Tutto in memoria: nessun file condiviso tra richieste concorrenti
+
+# Simboli per query IN nel caricamento batch (limite variabili delle vecchie versioni di SQLite)
+LOAD_CHUNK = 900
+
+
+class NoReportData(Exception):
+    pass
+
+
+def load_report_data(exchange, year, sector, exchanges_file="exchanges.txt", progress=None, skip_symbols=None):
+    # Dati grezzi delle aziende della borsa (e del settore, se indicato); progress(done, total) dopo ogni azienda.
+    # Si saltano solo le aziende già nel DB con un altro settore (indice faccette); skip_symbols, se passato,
+    # è lo stesso insieme calcolato dal chiamante (es. nel processo padre dei worker dei report)
+    exchanges = read_exchanges(exchanges_file)
+    companies = read_companies(exchanges[exchange])
+    if sector != "All":
+        if skip_symbols is None:
+            skip_symbols = get_facet_index(exchanges_file=exchanges_file).outside_sectors([exchange], [year], [sector])
+        companies = [c for c in companies if c["ticker"] not in skip_symbols]
+
+    data = []
+    for i, company in enumerate(companies, start=1):
+        comp_data = get_or_fetch_data(company["ticker"], [year], company.get("description", ""), exchange)
+        data.extend(sector_data(comp_data, sector))
+        if progress:
+            progress(i, len(companies))
+    return data
+
+
+def load_exchange_year_data(exchange, year, exchanges_file="exchanges.txt"):
+    # Tutti i dati già nel DB per una borsa e un anno, con poche query: base comune per i report di ogni settore
+    companies = read_companies(read_exchanges(exchanges_file)[exchange])
+    descriptions = {}
+    for company in companies:
+        ticker = (company.get("ticker") or "").strip()
+        if ticker:
+            descriptions.setdefault(ticker, company.get("description", ""))
+
+    symbols = list(descriptions)
+    data = []
+    for start in range(0, len(symbols), LOAD_CHUNK):
+        rows = load_many_from_db(symbols[start:start + LOAD_CHUNK], [year])
+        for (symbol, _), record in sorted(rows.items()):
+            if record:
+                record["description"] = descriptions[symbol]
+                record["stock_exchange"] = exchange
+                data.append(record)
+    return data
+
+
+def sector_data(data, sector):
+    if sector == "All":
+        return data
+    return [d for d in data if normalize_sector(d.get("sector")) == sector]
+
+
+def compute_report_kpis(data, year):
+    # Statistiche dei KPI (mediana, IQR, media winsorizzata, conteggi) e commenti automatici
+    stats = summary_stats(report_kpi_frame(data, year))
+    if not stats["count"].any():
+        raise NoReportData("Nessun KPI disponibile per i filtri selezionati.")
+    return stats, report_comments(stats)
+
+
+def build_report_pdf(exchange, year, sector, stats, comments):
+    # Restituisce il PDF come bytes
+    pdf_buffer = io.BytesIO()
+    doc = SimpleDocTemplate(pdf_buffer, pagesize=A4, title="BalanceShip Report", author="BalanceShip", subject="Financial report", creator="BalanceShip Platform")
+    styles = getSampleStyleSheet()
+    story = []
+
+    # Logo
+    logo1_path = os.path.join("images", "logo1.png")
+    logo2_path = os.path.join("images", "logo2.png")
+    logos = []
+    if os.path.exists(logo1_path):
+        logos.append(Image(logo1_path, width=80, height=70))
+    if os.path.exists(logo2_path):
+        logos.append(Image(logo2_path, width=160, height=40))
+    if logos:
+        table = Table([logos], hAlign='CENTER')
+        table.setStyle(TableStyle([('VALIGN',(0,0),(-1,-1),'MIDDLE'),
+                                   ('ALIGN',(0,0),(-1,-1),'CENTER'),
+                                   ('LEFTPADDING',(0,0),(-1,-1),0),
+                                   ('RIGHTPADDING',(0,0),(-1,-1),0),
+                                   ('TOPPADDING',(0,0),(-1,-1),0),
+                                   ('BOTTOMPADDING',(0,0),(-1,-1),0)]))
+        story.append(table)
+        story.append(Spacer(1,12))
+
+    story.append(Paragraph("<b>BalanceShip Report</b>", styles["Title"]))
+    story.append(Spacer(1,12))
+    story.append(Paragraph(f"<b>Exchange:</b> {exchange}", styles["Normal"]))
+    story.append(Paragraph(f"<b>Year:</b> {year}", styles["Normal"]))
+    story.append(Paragraph(f"<b>Sector:</b> {sector}", styles["Normal"]))
+    story.append(Spacer(1,12))
+
+    story.append(Paragraph("<b>Median KPIs:</b>", styles["Heading2"]))
+    rows = [["KPI", "Companies", "Median", "Q1", "Q3", "IQR", "Winsorized mean"]]
+    for kpi, row in stats.iterrows():
+        rows.append([kpi, str(row["count"])] + [format_kpi_value(kpi, row[c]) for c in ("median", "q1", "q3", "iqr", "winsorized_mean")])
+    stats_table = Table(rows, hAlign='LEFT')
+    stats_table.setStyle(TableStyle([('FONTNAME',(0,0),(-1,0),'Helvetica-Bold'),
+                                     ('ALIGN',(1,0),(-1,-1),'RIGHT'),
+                                     ('LINEBELOW',(0,0),(-1,0),0.5,'#0173C4')]))
+    story.append(stats_table)
+
+    story.append(PageBreak())
+    story.append(Paragraph("<b>KPI Chart</b>", styles["Heading2"]))
+    story.append(Spacer(1,12))
+
+    chart_buffer = io.BytesIO(kpi_chart_png(stats["median"].dropna()))
+    story.append(Image(chart_buffer, width=400, height=250))
+
+    story.append(PageBreak())
+    story.append(Paragraph("<b>Automated Insights</b>", styles["Heading1"]))
+    story.append(Spacer(1,12))
+    for c in comments:
+        story.append(Paragraph(f"- {c}", styles["Normal"]))
+
+    doc.build(story)
+    return pdf_buffer.getvalue()
+
+
+def build_report(exchange, year, sector, data):
+    # PDF da dati già caricati; solleva NoReportData se non ci sono dati
+    if not data:
+        raise NoReportData("No data found for the selected filters.")
+    stats, comments = compute_report_kpis(data, year)
+    return build_report_pdf(exchange, year, sector, stats, comments)
+
+
+def generate_report(exchange, year, sector, progress=None, skip_symbols=None):
+    # PDF del report come bytes (scarica i dati mancanti)
+    data = load_report_data(exchange, year, sector, progress=progress, skip_symbols=skip_symbols)
+    return build_report(exchange, year, sector, data)
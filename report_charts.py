@@ -0,0 +1,36 @@
+import io
+
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+# Grafici dei report con l'API a oggetti di matplotlib (Figure + canvas Agg), senza pyplot:
+# nessuno stato globale condiviso, quindi si possono generare in parallelo da un pool di thread
+
+CHART_COLOR = "#0173C4"
+
+
+def render_bar_chart(values, title, ylabel, figsize=(6, 4), dpi=100):
+    # values: pd.Series (indice = etichette). Restituisce il PNG come bytes
+    labels = [str(label) for label in values.index]
+    heights = [float(v) for v in values.values]
+
+    fig = Figure(figsize=figsize, dpi=dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    positions = range(len(heights))
+    bars = ax.bar(positions, heights, color=CHART_COLOR)
+    ax.set_title(title)
+    ax.set_ylabel(ylabel)
+    ax.set_xticks(positions, labels, rotation=45, ha="right")
+    # Etichette appena sopra (o sotto, se negative) le barre, a qualsiasi scala dei valori
+    ax.bar_label(bars, fmt="%.2f", padding=2)
+    ax.margins(y=0.12)
+    fig.tight_layout()
+
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png")
+    return buffer.getvalue()
+
+
+def kpi_chart_png(median_values):
+    return render_bar_chart(median_values, "Median KPIs", "Value")
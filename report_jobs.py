@@ -0,0 +1,152 @@
+import os
+import time
+import uuid
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from cache_db import get_data_version
+from facets import get_facet_index
+from report_store import ReportArtifactStore, DiskReportCache, REPORT_DATA_VERSION, report_key
+
+logger = logging.getLogger("report_jobs")
+
+# Coda di generazione report in processi separati: la pagina riceve un job_id e ne legge lo stato
+# senza bloccare lo script Streamlit. Stati: queued -> running -> done | failed.
+# I PDF finiti restano in memoria e su disco: richieste identiche con gli stessi dati sono immediate
+
+REPORT_WORKERS = int(os.environ.get("REPORT_WORKERS", max(1, min(2, os.cpu_count() or 1))))
+# I job terminati restano consultabili per questo numero di secondi
+JOB_TTL = 3600
+
+
+def _init_worker():
+    # Le connessioni del pool ereditate dal processo padre non vanno riusate nel worker.
+    # Coordinatore dei download, fonte dati, limitatori e visualizzazioni in attesa sono azzerati nel figlio
+    # dagli hook os.register_at_fork dei rispettivi moduli (vale per ogni fork, non solo per questo pool)
+    from cache_db import engine, read_engine
+    engine.dispose(close=False)
+    if read_engine is not engine:
+        read_engine.dispose(close=False)
+
+
+def _run_job(job_id, exchange, year, sector, skip_symbols, progress_store):
+    # Eseguito nel processo worker: (versione dei dati dopo il caricamento, PDF).
+    # Il caricamento può scaricare e salvare dati, quindi la versione va letta dopo
+    from report_builder import load_report_data, build_report
+
+    def progress(done, total):
+        progress_store[job_id] = (done, total)
+
+    progress_store[job_id] = (0, 0)
+    data = load_report_data(exchange, year, sector, progress=progress, skip_symbols=skip_symbols)
+    version = get_data_version(REPORT_DATA_VERSION)
+    return version, build_report(exchange, year, sector, data)
+
+
+class ReportQueue:
+    def __init__(self, max_workers=REPORT_WORKERS, store=None, disk=None):
+        # "fork": con "spawn" il worker rieseguirebbe lo script della pagina, che Streamlit registra come __main__
+        context = multiprocessing.get_context("fork")
+        self._manager = context.Manager()
+        self._progress = self._manager.dict()
+        self._executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=context, initializer=_init_worker)
+        self.store = store or ReportArtifactStore()
+        self.disk = disk or DiskReportCache()
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._active = {}
+
+    def submit(self, exchange, year, sector):
+        # Richieste identiche ancora in corso condividono lo stesso job; a fine job il PDF è salvato
+        # con la versione letta dopo il caricamento dei dati (vedi _finish)
+        key = report_key(exchange, year, sector, get_data_version(REPORT_DATA_VERSION))
+        # Aziende di altri settori risolte qui con l'indice delle faccette del processo: i worker non lo ricostruiscono
+        skip_symbols = None if sector == "All" else get_facet_index().outside_sectors([exchange], [str(year)], [sector])
+        with self._lock:
+            self._prune()
+            job_id = self._active.get(key)
+            if job_id is not None:
+                return job_id
+
+            job_id = uuid.uuid4().hex
+            job = {
+                "key": key, "request": (exchange, year, sector), "state": "queued", "submitted_at": time.time(),
+                "result": None, "error": None,
+            }
+            self._jobs[job_id] = job
+
+            cached = self._cached(key)
+            if cached is not None:
+                job.update(state="done", result=cached, finished_at=time.time())
+                logger.info(f"Report {key} servito dallo store: job {job_id}")
+                return job_id
+
+            self._active[key] = job_id
+            future = self._executor.submit(_run_job, job_id, exchange, str(year), sector, skip_symbols, self._progress)
+        future.add_done_callback(lambda f, job_id=job_id: self._finish(job_id, f))
+        logger.info(f"Report in coda {key}: job {job_id}")
+        return job_id
+
+    def _cached(self, key):
+        # Memoria, poi disco (promuovendo il PDF in memoria)
+        pdf = self.store.get(key)
+        if pdf is None:
+            pdf = self.disk.get(key)
+            if pdf is not None:
+                self.store.put(key, pdf)
+        return pdf
+
+    def _prune(self):
+        now = time.time()
+        expired = [j for j, job in self._jobs.items() if now - job.get("finished_at", now) > JOB_TTL]
+        for job_id in expired:
+            del self._jobs[job_id]
+            self._progress.pop(job_id, None)
+
+    def _finish(self, job_id, future):
+        with self._lock:
+            job = self._jobs[job_id]
+            self._active.pop(job["key"], None)
+            try:
+                version, job["result"] = future.result()
+                job["key"] = report_key(*job["request"], version)
+                job["state"] = "done"
+                self.store.put(job["key"], job["result"])
+            except Exception as e:
+                job["error"] = str(e) or type(e).__name__
+                job["state"] = "failed"
+                logger.warning(f"Report {job_id} fallito: {job['error']}")
+            job["finished_at"] = time.time()
+        # Scrittura su disco fuori dal lock: status() non attende l'I/O
+        if job["state"] == "done":
+            self.disk.put(job["key"], job["result"])
+
+    def status(self, job_id):
+        # dict con state, done, total, result (bytes del PDF), error; None se il job non esiste
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            done, total = self._progress.get(job_id, (0, 0))
+            state = job["state"]
+            if state == "queued" and job_id in self._progress:
+                state = "running"
+            return {"state": state, "done": done, "total": total, "result": job["result"], "error": job["error"]}
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._manager.shutdown()
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_report_queue():
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = ReportQueue()
+        return _queue
@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+
+from data_utils import dedupe_financial_frame
+
+# Statistiche dei KPI di settore per i report, calcolate in un solo passaggio vettoriale:
+# niente compute_kpis riga per riga, inf (divisioni per zero) trattati come dati mancanti.
+# I margini sono frazioni (0.20 = 20%), le soglie dei commenti sono nella stessa unità.
+
+# KPI del report: nome -> (numeratore, denominatore); None = colonna grezza
+REPORT_KPIS = {
+    "EBITDA Margin": ("ebitda", "total_revenue"),
+    "Debt/Equity": ("total_debt", "stockholders_equity"),
+    "FCF Margin": ("free_cash_flow", "total_revenue"),
+    "EPS": ("basic_eps", None),
+}
+PERCENT_KPIS = {"EBITDA Margin", "FCF Margin"}
+
+# Quota di code tagliate per lato nella media winsorizzata
+WINSOR = 0.05
+
+# (soglia alta, soglia media, commento alto, medio, basso), confrontate con la mediana
+COMMENT_RULES = {
+    "EBITDA Margin": (0.20, 0.10, "EBITDA strong", "EBITDA moderate", "EBITDA weak"),
+    "Debt/Equity": (2, 1, "High leverage", "Moderate leverage", "Low leverage"),
+    "FCF Margin": (0.15, 0.05, "Strong cash flow", "Moderate cash flow", "Weak cash flow"),
+    "EPS": (5, 1, "High EPS", "Moderate EPS", "Low EPS"),
+}
+
+STAT_COLUMNS = ["count", "median", "q1", "q3", "iqr", "winsorized_mean"]
+
+
+def _numeric(series):
+    # Come to_float di compute_kpis: accetta anche stringhe con separatori delle migliaia e negativi tra parentesi
+    if series.dtype == object:
+        series = series.astype("string").str.replace(",", "", regex=False).str.replace("(", "-", regex=False).str.replace(")", "", regex=False)
+    return pd.to_numeric(series, errors="coerce").astype("float64")
+
+
+def report_kpi_frame(data, year):
+    # Una riga per azienda dell'anno richiesto, colonne = REPORT_KPIS
+    df = pd.DataFrame.from_records(data) if not isinstance(data, pd.DataFrame) else data
+    if df.empty or "symbol" not in df.columns or "year" not in df.columns:
+        return pd.DataFrame(columns=["symbol"] + list(REPORT_KPIS))
+    df = df[pd.to_numeric(df["year"], errors="coerce") == int(year)]
+    df = dedupe_financial_frame(df)
+
+    raw = {}
+    kpis = {"symbol": df["symbol"].to_numpy()}
+    for name, (num, den) in REPORT_KPIS.items():
+        for col in (num, den):
+            if col and col not in raw:
+                raw[col] = _numeric(df[col]).to_numpy() if col in df.columns else np.full(len(df), np.nan)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            kpis[name] = raw[num] / raw[den] if den else raw[num]
+    frame = pd.DataFrame(kpis)
+    frame[list(REPORT_KPIS)] = frame[list(REPORT_KPIS)].replace([np.inf, -np.inf], np.nan)
+    return frame
+
+
+def summary_stats(kpi_frame, winsor=WINSOR):
+    # KPI -> count, median, q1, q3, iqr, winsorized_mean (NaN ignorati)
+    columns = [c for c in REPORT_KPIS if c in kpi_frame.columns]
+    values = kpi_frame[columns].to_numpy(dtype="float64")
+    counts = np.sum(~np.isnan(values), axis=0)
+    stats = pd.DataFrame(np.nan, index=columns, columns=STAT_COLUMNS)
+    stats["count"] = counts
+    valid = counts > 0
+    if valid.any():
+        v = values[:, valid]
+        lo, q1, median, q3, hi = np.nanquantile(v, [winsor, 0.25, 0.5, 0.75, 1 - winsor], axis=0)
+        stats.loc[valid, "median"] = median
+        stats.loc[valid, "q1"] = q1
+        stats.loc[valid, "q3"] = q3
+        stats.loc[valid, "iqr"] = q3 - q1
+        stats.loc[valid, "winsorized_mean"] = np.nanmean(np.clip(v, lo, hi), axis=0)
+    stats["count"] = stats["count"].astype("int64")
+    return stats
+
+
+def report_comments(stats):
+    comments = []
+    for kpi, (high, mid, high_text, mid_text, low_text) in COMMENT_RULES.items():
+        if kpi not in stats.index or not stats.at[kpi, "count"]:
+            continue
+        median = stats.at[kpi, "median"]
+        comments.append(high_text if median > high else mid_text if median > mid else low_text)
+    return comments
+
+
+def format_kpi_value(kpi, value):
+    if pd.isna(value):
+        return "n/a"
+    return f"{value * 100:.1f}%" if kpi in PERCENT_KPIS else f"{value:.2f}"
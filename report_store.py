@@ -0,0 +1,136 @@
+import os
+import json
+import uuid
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger("report_store")
+
+# Report PDF già generati: in memoria e su disco, entrambi con eviction LRU su numero e dimensione totale.
+# Chiave: (exchange, year, sector, data_version), così un cambio dei dati invalida i report vecchi
+
+MAX_REPORTS = 64
+MAX_BYTES = 64 * 1024 * 1024
+
+REPORTS_DIR = os.environ.get("REPORTS_CACHE_DIR", os.path.join("data", "reports"))
+DISK_MAX_REPORTS = int(os.environ.get("REPORTS_CACHE_MAX_FILES", 500))
+DISK_MAX_BYTES = int(os.environ.get("REPORTS_CACHE_MAX_MB", 512)) * 1024 * 1024
+# Contatori di versione da cui dipende un report: le scritture dei KPI calcolati non invalidano i PDF
+REPORT_DATA_VERSION = ('financials',)
+# Da incrementare quando cambia il contenuto del PDF a parità di dati (layout, KPI, commenti)
+REPORT_FORMAT = 2
+
+
+def report_key(exchange, year, sector, data_version):
+    return (exchange, str(year), sector, data_version)
+
+
+def report_digest(key):
+    # Nome file del report: hash degli input, stabile tra processi e riavvii
+    payload = json.dumps([REPORT_FORMAT, *key], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ReportArtifactStore:
+    def __init__(self, max_reports=MAX_REPORTS, max_bytes=MAX_BYTES):
+        self.max_reports = max_reports
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            pdf = self._items.get(key)
+            if pdf is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return pdf
+
+    def put(self, key, pdf):
+        if len(pdf) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._items[key] = pdf
+            self._size += len(pdf)
+            while len(self._items) > self.max_reports or self._size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._size -= len(evicted)
+
+    def stats(self):
+        with self._lock:
+            return {"reports": len(self._items), "bytes": self._size, "hits": self.hits, "misses": self.misses}
+
+
+class DiskReportCache:
+    # Un file <hash>.pdf per report. La lettura aggiorna mtime, che fa da ordine LRU per l'eviction;
+    # la scrittura passa da un file temporaneo + os.replace, così altri processi non leggono PDF parziali
+    def __init__(self, directory=REPORTS_DIR, max_reports=DISK_MAX_REPORTS, max_bytes=DISK_MAX_BYTES):
+        self.directory = directory
+        self.max_reports = max_reports
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{report_digest(key)}.pdf")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                pdf = f.read()
+            os.utime(path)
+            return pdf
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logger.warning(f"Errore lettura report {path}: {e}")
+            return None
+
+    def put(self, key, pdf):
+        path = self._path(key)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(pdf)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Errore scrittura report {path}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self.evict()
+
+    def evict(self):
+        with self._lock:
+            files = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".pdf"):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+            files.sort()
+            total = sum(size for _, size, _ in files)
+            while files and (len(files) > self.max_reports or total > self.max_bytes):
+                _, size, path = files.pop(0)
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    def stats(self):
+        sizes = [e.stat().st_size for e in os.scandir(self.directory) if e.name.endswith(".pdf")]
+        return {"reports": len(sizes), "bytes": sum(sizes)}
@@ -0,0 +1,134 @@
+import bisect
+import heapq
+import re
+import threading
+import unicodedata
+from collections import namedtuple
+from itertools import islice
+
+from data_utils import read_exchanges, read_companies
+
+# Un'azienda quotata: la chiave (ticker, exchange) è univoca anche quando le descrizioni si ripetono
+CompanyEntry = namedtuple("CompanyEntry", ["ticker", "exchange", "description"])
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+
+def normalize_text(text):
+    # minuscole senza accenti, per confronti indipendenti da maiuscole e diacritici
+    text = unicodedata.normalize("NFKD", str(text or ""))
+    return "".join(ch for ch in text if not unicodedata.combining(ch)).lower()
+
+
+def tokenize(text):
+    return _TOKEN_RE.findall(normalize_text(text))
+
+
+def trigrams(text):
+    text = f"  {normalize_text(text)} "
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class CompanySearchIndex:
+    # Ricerca per prefisso (ticker e parole della descrizione) su lista ordinata + bisect,
+    # con fallback fuzzy su trigrammi quando nessun prefisso corrisponde
+
+    def __init__(self, entries):
+        self.entries = list(entries)
+        self._normalized = [(normalize_text(e.ticker), normalize_text(e.description)) for e in self.entries]
+        self._by_key = {self.key(e): i for i, e in enumerate(self.entries)}
+
+        tokens = []
+        grams = {}
+        for i, entry in enumerate(self.entries):
+            tokens.append((self._normalized[i][0], i))
+            for token in set(tokenize(entry.ticker) + tokenize(entry.description)):
+                tokens.append((token, i))
+            for gram in trigrams(f"{entry.ticker} {entry.description}"):
+                grams.setdefault(gram, []).append(i)
+        tokens.sort()
+        self._tokens = [t for t, _ in tokens]
+        self._token_ids = [i for _, i in tokens]
+        self._grams = grams
+        # ordine di default (query vuota): alfabetico per descrizione
+        self._alphabetical = sorted(range(len(self.entries)), key=lambda i: self._normalized[i][1])
+
+    @classmethod
+    def from_exchanges(cls, exchanges):
+        entries = []
+        for exchange, filename in exchanges.items():
+            seen = set()
+            for company in read_companies(filename):
+                ticker = (company.get("ticker") or "").strip()
+                if ticker and ticker not in seen:
+                    seen.add(ticker)
+                    entries.append(CompanyEntry(ticker, exchange, (company.get("description") or "").strip()))
+        return cls(entries)
+
+    @staticmethod
+    def key(entry):
+        return f"{entry.ticker}|{entry.exchange}"
+
+    def get(self, key):
+        i = self._by_key.get(key)
+        return self.entries[i] if i is not None else None
+
+    def label(self, key):
+        entry = self.get(key)
+        if entry is None:
+            return key
+        return f"{entry.description} ({entry.ticker} · {entry.exchange})"
+
+    def _prefix_ids(self, prefix):
+        lo = bisect.bisect_left(self._tokens, prefix)
+        hi = bisect.bisect_left(self._tokens, prefix + "\uffff")
+        return set(self._token_ids[lo:hi])
+
+    def search(self, query, limit=20, exchanges=None):
+        # Restituisce al massimo `limit` CompanyEntry, le migliori prima
+        exchanges = set(exchanges) if exchanges else None
+        allowed = (lambda i: self.entries[i].exchange in exchanges) if exchanges else (lambda i: True)
+
+        words = tokenize(query)
+        if not words:
+            return [self.entries[i] for i in islice((i for i in self._alphabetical if allowed(i)), limit)]
+
+        # Ogni parola della query deve essere prefisso di un token dell'azienda
+        ids = None
+        for word in words:
+            matched = self._prefix_ids(word)
+            ids = matched if ids is None else ids & matched
+            if not ids:
+                break
+
+        if ids:
+            q = normalize_text(query).strip()
+
+            def rank(i):
+                ticker, description = self._normalized[i]
+                return (ticker != q, not ticker.startswith(q), not description.startswith(q), len(description), description)
+
+            ranked = heapq.nsmallest(limit, (i for i in ids if allowed(i)), key=rank)
+        else:
+            # Fuzzy: aziende con più trigrammi in comune con la query
+            counts = {}
+            for gram in trigrams(query):
+                for i in self._grams.get(gram, ()):
+                    counts[i] = counts.get(i, 0) + 1
+            threshold = max(2, len(trigrams(query)) // 2)
+            ranked = heapq.nsmallest(limit, (i for i, c in counts.items() if c >= threshold and allowed(i)), key=lambda i: -counts[i])
+
+        return [self.entries[i] for i in ranked]
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_search_index(exchanges_file="exchanges.txt"):
+    # Indice costruito una sola volta per processo
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = CompanySearchIndex.from_exchanges(read_exchanges(exchanges_file))
+        return _index
@@ -0,0 +1,44 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# I moduli leggono ambiente e percorsi relativi (data/, exchanges.txt) all'import: i test girano in una
+# cartella temporanea con un DB SQLite proprio, una borsa di prova e la fonte replay su registrazioni sintetiche
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.mkdtemp(prefix="balanceship-tests-")
+os.chdir(WORKDIR)
+sys.path.insert(0, ROOT)
+for name in ("STREAMLIT_CLOUD", "DATABASE_URL", "DATABASE_READ_URL"):
+    os.environ.pop(name, None)
+os.environ.update(
+    DATA_SOURCE="replay",
+    REPLAY_DIR=os.path.join(WORKDIR, "replay"),
+    REPLAY_LATENCY="0",
+    # Un download che non arriva deve far fallire i test in fretta, non dopo 300 s
+    FETCH_TIMEOUT="20",
+)
+
+from data_sources import write_synthetic_recordings  # noqa: E402
+
+EXCHANGE = "TEST"
+SYMBOLS = write_synthetic_recordings(os.environ["REPLAY_DIR"], 5, years=(2022, 2023))
+with open("exchanges.txt", "w") as f:
+    f.write(f"{EXCHANGE},test_companies.txt\n")
+with open("test_companies.txt", "w") as f:
+    f.write("ticker,description\n")
+    f.writelines(f"{symbol},{symbol} Inc\n" for symbol in SYMBOLS)
+
+
+@pytest.fixture(autouse=True)
+def empty_db():
+    # Ogni test parte da un DB senza dati (restano i contatori di versione e le aziende delle borse)
+    from cache_db import Base, engine, DataVersion, Company
+    from data_utils import read_exchanges, sync_company_table
+    with engine.begin() as conn:
+        for table in reversed(Base.metadata.sorted_tables):
+            if table.name not in (DataVersion.__tablename__, Company.__tablename__):
+                conn.execute(table.delete())
+    sync_company_table(read_exchanges("exchanges.txt"))
+    yield
@@ -0,0 +1,36 @@
+import datetime
+
+from cache_db import record_missing
+from conftest import SYMBOLS
+from data_utils import get_all_financial_data, iter_all_financial_data
+from refresh_planner import plan_refresh
+
+YEARS = ["2022", "2023"]
+
+
+def as_rows(records):
+    return sorted((dict(r) for r in records), key=lambda r: (r['symbol'], r['year']))
+
+
+def test_chunked_iteration_matches_get_all_financial_data():
+    batches = list(iter_all_financial_data(force_refresh=False, years=YEARS, chunk_size=2))
+    assert [batch[0]['symbol'] for batch in batches] == SYMBOLS
+    assert all(len(batch) == len(YEARS) for batch in batches)
+
+    everything = [r for r in get_all_financial_data(force_refresh=False) if str(r['year']) in YEARS]
+    assert as_rows(r for batch in batches for r in batch) == as_rows(everything)
+
+
+def test_plan_refresh_without_stale_rows_plans_only_missing_ones():
+    list(iter_all_financial_data(force_refresh=False, years=["2023"], chunk_size=2))
+    later = datetime.datetime.utcnow() + datetime.timedelta(days=400)
+
+    # 2023 è nel DB per tutti i simboli, 2022 manca
+    assert plan_refresh(SYMBOLS, YEARS, now=later, stale=False) == {symbol: ["2022"] for symbol in SYMBOLS}
+    assert plan_refresh(SYMBOLS, YEARS, now=later) == {symbol: YEARS for symbol in SYMBOLS}
+
+    # La cache negativa vale anche con stale=False
+    record_missing(SYMBOLS[0], [2022])
+    plan = plan_refresh(SYMBOLS, YEARS, stale=False)
+    assert SYMBOLS[0] not in plan
+    assert plan == {symbol: ["2022"] for symbol in SYMBOLS[1:]}
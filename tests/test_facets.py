@@ -0,0 +1,44 @@
+from cache_db import Session, save_to_db, bump_data_version
+from conftest import EXCHANGE, SYMBOLS
+from facets import FacetIndex, get_facet_index
+
+
+def record(symbol, year, sector):
+    return {'symbol': symbol, 'year': year, 'sector': sector, 'industry': f"{sector} 1", 'net_income': 1.0}
+
+
+def test_own_saves_do_not_rebuild_the_index(monkeypatch):
+    index = get_facet_index(rebuild=True)
+    builds = []
+    original = FacetIndex.build
+    monkeypatch.setattr(FacetIndex, "build", lambda self: builds.append(1) or original(self))
+
+    save_to_db(SYMBOLS[0], [2023], [record(SYMBOLS[0], 2023, 'Energy')])
+    assert get_facet_index() is index
+    assert builds == []
+    assert index.symbols([EXCHANGE], ["2023"], ["Energy"]) == {SYMBOLS[0]}
+
+    # Scrittura di un altro processo: solo la versione nel DB cambia
+    session = Session()
+    bump_data_version(session, 'financials')
+    session.commit()
+    session.close()
+    get_facet_index()
+    assert builds == [1]
+
+
+def test_report_data_keeps_companies_not_yet_downloaded():
+    from data_sources import get_data_source
+    from report_builder import load_report_data
+
+    sectors = {symbol: get_data_source().fetch(symbol, ["2023"])[0]['sector'] for symbol in SYMBOLS}
+    # Un settore con almeno due aziende: una già nel DB, l'altra ancora da scaricare
+    sector = next(s for s in sectors.values() if list(sectors.values()).count(s) > 1)
+    cached = next(symbol for symbol in SYMBOLS if sectors[symbol] == sector)
+    other = next(symbol for symbol in SYMBOLS if sectors[symbol] != sector)
+    for symbol in (cached, other):
+        save_to_db(symbol, [2023], [record(symbol, 2023, sectors[symbol])])
+    get_facet_index(rebuild=True)
+
+    data = load_report_data(EXCHANGE, "2023", sector)
+    assert {d['symbol'] for d in data} == {symbol for symbol in SYMBOLS if sectors[symbol] == sector}
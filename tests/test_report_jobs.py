@@ -0,0 +1,34 @@
+import time
+
+from cache_db import load_many_from_db
+from conftest import EXCHANGE, SYMBOLS
+from data_utils import get_or_fetch_data
+from report_jobs import ReportQueue
+
+
+def wait_job(queue, job_id, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        status = queue.status(job_id)
+        if status["state"] in ("done", "failed"):
+            return status
+        time.sleep(0.1)
+    raise AssertionError(f"job {job_id} non terminato in {timeout} s")
+
+
+def test_report_job_downloads_missing_data():
+    # Un download nel padre avvia i thread del coordinatore prima del fork: il worker deve usarne uno proprio
+    assert get_or_fetch_data(SYMBOLS[0], ["2022"], "", EXCHANGE)[0]
+    queue = ReportQueue(max_workers=1)
+    try:
+        started = time.monotonic()
+        status = wait_job(queue, queue.submit(EXCHANGE, "2023", "All"))
+        elapsed = time.monotonic() - started
+    finally:
+        queue.shutdown()
+
+    assert status["state"] == "done", status["error"]
+    assert status["result"].startswith(b"%PDF")
+    assert elapsed < 20
+    rows = load_many_from_db(SYMBOLS, ["2023"], primary=True)
+    assert {symbol for symbol, year in rows if rows[(symbol, year)]} == set(SYMBOLS)